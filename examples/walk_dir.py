@@ -4,6 +4,8 @@ This workflow traverses the specified directory recursively and counts the numbe
 files and accumulates their total size. Symbolic links are not counted.
 
 """
+from stat import S_ISLNK
+
 from lightflow.models import Parameters, Option, Dag
 from lightflow_filesystem import WalkTask
 from lightflow.tasks import PythonTask
@@ -21,11 +23,12 @@ def setup(data, store, signal, context):
     data['size'] = 0
 
 
-# acquire some basic statistics for each file as long as it is not a symbolic link
-def acquire_stats(entry, data, store, signal, context):
-    if not entry.is_symlink():
-        data['count'] += 1
-        data['size'] += entry.stat(follow_symlinks=False).st_size
+# acquire some basic statistics for a batch of files, skipping symbolic links
+def acquire_stats(records, data, store, signal, context):
+    for record in records:
+        if not S_ISLNK(record.mode):
+            data['count'] += 1
+            data['size'] += record.size
 
 
 # print the acquired statistics
@@ -39,11 +42,13 @@ def print_stats(data, store, signal, context):
 setup_task = PythonTask(name='setup_task',
                         callback=setup)
 
-# traverse a directory and call the statistics callable for each file
+# traverse a directory and call the statistics callable for each batch of 1000 files
 walk_task = WalkTask(name='walk_task',
                      path=lambda data, store: store.get('path'),
                      callback=acquire_stats,
-                     recursive=True)
+                     recursive=True,
+                     batch_size=1000,
+                     records=True)
 
 # print the acquired statistics
 print_task = PythonTask(name='print_task',
@@ -0,0 +1,201 @@
+import pickle
+import tempfile
+import threading
+from collections import deque
+
+
+# the ways of handling a new batch while the queue of the dispatcher is full
+POLICY_BLOCK = 'block'
+POLICY_COALESCE = 'coalesce'
+POLICY_SPILL = 'spill'
+POLICIES = (POLICY_BLOCK, POLICY_COALESCE, POLICY_SPILL)
+
+
+class BatchDispatcher:
+    """ Hands batches of files to a callback from a separate thread.
+
+    Batches are put into a bounded queue, from which a dispatcher thread takes them
+    one by one and calls the callback, such that a slow callback does not hold up
+    the thread reading the filesystem events. Once the queue is full, a new batch is
+    handled according to the policy:
+
+        block: wait until the dispatcher thread has taken a batch from the queue.
+        coalesce: merge the batch into the last batch of the queue that has the
+                  same root and group. If there is none, or the merged batch
+                  would exceed the maximum number of files, wait as for block.
+        spill: append the batch to a temporary file, from which it is read back
+               once the queue has been emptied. Batches keep their order.
+
+    An exception raised by the callback stops the dispatcher thread and is raised
+    again by the next call to put(), check() or close().
+    """
+    def __init__(self, callback, max_pending=100, policy=POLICY_BLOCK, spill_dir=None,
+                 max_files=None):
+        """ Initialize the batch dispatcher.
+
+        Args:
+            callback (callable): The callable that is called with each batch.
+            max_pending (int): The maximum number of batches in the queue.
+            policy (str): The policy for batches that arrive while the queue is full.
+                          One of 'block', 'coalesce' or 'spill'.
+            spill_dir (str, None): The directory of the temporary spill file.
+                                   Defaults to the system's temporary directory.
+            max_files (int, None): The maximum number of files of a coalesced batch.
+                                   Set to None for no limit.
+        """
+        self._callback = callback
+        self._max_pending = max(max_pending, 1)
+        self._policy = policy
+        self._spill_dir = spill_dir
+        self._max_files = max_files
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._active = 0
+        self._closing = False
+        self._error = None
+
+        self._spill = None
+        self._spilled = 0
+        self._spill_offset = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queue) + self._spilled + self._active
+
+    def start(self):
+        """ Start the dispatcher thread. """
+        self._thread.start()
+
+    def put(self, batch):
+        """ Queue a batch for being handed to the callback.
+
+        Args:
+            batch (FileBatch): The batch of files.
+
+        Raises:
+            Exception: The exception raised by the callback, if any.
+        """
+        with self._condition:
+            self._raise_error()
+            if self._spilled > 0 or len(self._queue) >= self._max_pending:
+                if self._policy == POLICY_COALESCE and self._coalesce(batch):
+                    return
+                if self._policy == POLICY_SPILL:
+                    self._write_spill(batch)
+                    self._condition.notify_all()
+                    return
+
+                while len(self._queue) >= self._max_pending and self._error is None:
+                    self._condition.wait()
+                self._raise_error()
+
+            self._queue.append(batch)
+            self._condition.notify_all()
+
+    def check(self):
+        """ Raise the exception of the callback, if the callback failed. """
+        with self._condition:
+            self._raise_error()
+
+    def close(self, drain=True):
+        """ Stop the dispatcher thread.
+
+        Args:
+            drain (bool): Hand all queued batches to the callback before stopping.
+                          Otherwise only the batch that is currently being handed
+                          over is completed.
+
+        Raises:
+            Exception: The exception raised by the callback, if any.
+        """
+        with self._condition:
+            if not drain:
+                self._queue.clear()
+                self._spilled = 0
+            self._closing = True
+            self._condition.notify_all()
+
+        if self._thread.is_alive():
+            self._thread.join()
+
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+        if drain:
+            self.check()
+
+    def _run(self):
+        """ Take batches from the queue and hand them to the callback. """
+        while True:
+            with self._condition:
+                while not self._queue and self._spilled == 0 and not self._closing:
+                    self._condition.wait()
+
+                if self._queue:
+                    batch = self._queue.popleft()
+                elif self._spilled > 0:
+                    batch = self._read_spill()
+                else:
+                    return
+                self._active = 1
+                self._condition.notify_all()
+
+            try:
+                self._callback(batch)
+            except Exception as e:
+                with self._condition:
+                    self._active = 0
+                    self._error = e
+                    self._condition.notify_all()
+                return
+
+            with self._condition:
+                self._active = 0
+
+    def _raise_error(self):
+        """ Raise the exception of the callback. Has to be called with the lock held. """
+        if self._error is not None:
+            raise self._error
+
+    def _coalesce(self, batch):
+        """ Merge a batch into the last queued batch of the same root and group.
+
+        Returns:
+            bool: True if the batch was merged.
+        """
+        root = getattr(batch, 'root', None)
+        group = getattr(batch, 'group', None)
+        for queued in reversed(self._queue):
+            if getattr(queued, 'root', None) == root and \
+                    getattr(queued, 'group', None) == group:
+                if self._max_files is not None and \
+                        len(queued) + len(batch) > self._max_files:
+                    return False
+                queued.extend(batch)
+                return True
+        return False
+
+    def _write_spill(self, batch):
+        """ Append a batch to the spill file. """
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(dir=self._spill_dir,
+                                                 prefix='lightflow_spill_')
+        self._spill.seek(0, 2)
+        pickle.dump(batch, self._spill, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spilled += 1
+
+    def _read_spill(self):
+        """ Read the oldest batch from the spill file. """
+        self._spill.seek(self._spill_offset)
+        batch = pickle.load(self._spill)
+        self._spilled -= 1
+        if self._spilled == 0:
+            self._spill.truncate(0)
+            self._spill_offset = 0
+        else:
+            self._spill_offset = self._spill.tell()
+        return batch
@@ -0,0 +1,140 @@
+import threading
+from collections import deque
+
+from lightflow.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class DagLimiter:
+    """ Keeps track of the dags a trigger task started and that are still running.
+
+    The callback of the trigger task is handed the signal returned by the signal
+    property, which records the name of each dag it starts. A single thread waits
+    for the started dags to terminate in the order they were started, such that at
+    most one join request of the limiter circles through the request queue of
+    Lightflow at any time. A dag that terminates before an older one is therefore
+    only counted as terminated once the older ones did, which errs on the side of
+    fewer running dags. The figures are written to the data store whenever they
+    change, if a key is given.
+    """
+    def __init__(self, signal, max_running, store=None, store_key=None):
+        """ Initialize the dag limiter.
+
+        Args:
+            signal (TaskSignal): The signal object of the trigger task.
+            max_running (int): The maximum number of running dags.
+            store (DataStoreDocument, None): The data store the figures are
+                                             written to.
+            store_key (str, None): The key under which the figures are stored.
+                                   Set to None to not store the figures.
+        """
+        self._signal = signal
+        self._max_running = max_running
+        self._store = store
+        self._store_key = store_key
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._running = deque()
+        self._tracker = None
+        self._closed = False
+        self._started = 0
+        self._finished = 0
+
+    @property
+    def signal(self):
+        """ TaskSignal: A signal object that records the dags it starts. """
+        return _TrackingSignal(self._signal, self)
+
+    @property
+    def running(self):
+        """ int: The number of started dags that are still running. """
+        with self._lock:
+            return len(self._running)
+
+    def available(self, reserved=0):
+        """ Return the number of dags that can be started without exceeding the limit.
+
+        Args:
+            reserved (int): The number of dags that are about to be started.
+
+        Returns:
+            int: The number of dags, which is zero while at the limit.
+        """
+        return max(0, self._max_running - self.running - reserved)
+
+    def track(self, name):
+        """ Record a started dag, whose termination is awaited by the tracking thread.
+
+        Args:
+            name (str): The name of the dag.
+        """
+        with self._lock:
+            self._running.append(name)
+            self._started += 1
+            self._changed.notify()
+            if self._tracker is None:
+                self._tracker = threading.Thread(target=self._track, daemon=True)
+                self._tracker.start()
+        self._store_stats()
+
+    def close(self):
+        """ Stop the tracking thread.
+
+        The thread exits right away if it is idle, otherwise once the dag it is
+        currently waiting for has terminated, since a join request cannot be
+        cancelled.
+        """
+        with self._lock:
+            self._closed = True
+            self._changed.notify()
+
+    def _track(self):
+        """ Wait for the oldest running dag to terminate, one dag at a time. """
+        while True:
+            with self._lock:
+                while not self._running and not self._closed:
+                    self._changed.wait()
+                if self._closed:
+                    return
+                name = self._running[0]
+
+            try:
+                self._signal.join_dags([name])
+            except Exception as e:
+                logger.error('Could not wait for dag {}: {}'.format(name, e))
+
+            with self._lock:
+                self._running.popleft()
+                self._finished += 1
+            self._store_stats()
+
+    def _store_stats(self):
+        """ Write the figures of the started and running dags to the data store. """
+        if self._store is None or self._store_key is None:
+            return
+
+        with self._lock:
+            stats = {'running': len(self._running),
+                     'max_running': self._max_running,
+                     'started': self._started,
+                     'finished': self._finished}
+        self._store.set(self._store_key, stats)
+
+
+class _TrackingSignal:
+    """ Wraps a task signal and reports each started dag to the dag limiter. """
+    def __init__(self, signal, limiter):
+        self._signal = signal
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self._signal, name)
+
+    def start_dag(self, dag, *, data=None):
+        """ Start a dag and record its name. See TaskSignal.start_dag(). """
+        name = self._signal.start_dag(dag, data=data)
+        self._limiter.track(name)
+        return name
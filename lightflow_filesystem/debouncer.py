@@ -0,0 +1,76 @@
+import heapq
+import time
+
+
+class Debouncer:
+    """ Holds back file paths until no further events arrived for a settle time.
+
+    Each path is stored together with its deadline and an optional value in a
+    dictionary. The deadlines are ordered in a heap, such that expired paths are found
+    without scanning all entries. Refreshing a path only updates its dictionary entry.
+    The heap entry is corrected lazily when it reaches the top of the heap, which
+    keeps the heap at one entry per path regardless of the number of events.
+    """
+    def __init__(self, settle_time):
+        """ Initialize the debouncer.
+
+        Args:
+            settle_time (float): The time in seconds without events after which a
+                                 path is considered settled.
+        """
+        self._settle_time = settle_time
+        self._deadlines = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, path):
+        return path in self._deadlines
+
+    def touch(self, path, value=None, now=None):
+        """ Add a path or restart its settle time.
+
+        Args:
+            path (str): The path of the file.
+            value: A value that is returned together with the path once it settled.
+                   The value of a path that is pending already is kept.
+            now (float, None): The current monotonic time. Defaults to the current time.
+        """
+        deadline = (time.monotonic() if now is None else now) + self._settle_time
+        entry = self._deadlines.get(path)
+        if entry is None:
+            heapq.heappush(self._heap, (deadline, path))
+        else:
+            value = entry[1]
+        self._deadlines[path] = (deadline, value)
+
+    def next_deadline(self):
+        """ Return the earliest monotonic time at which a path might settle.
+
+        Returns:
+            float: The deadline or None if no paths are pending.
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now=None):
+        """ Remove and return all paths that have settled.
+
+        Args:
+            now (float, None): The current monotonic time. Defaults to the current time.
+
+        Returns:
+            list: The settled (path, value) tuples in the order of their deadlines.
+        """
+        now = time.monotonic() if now is None else now
+
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, path = heapq.heappop(self._heap)
+            current, value = self._deadlines[path]
+            if current > deadline:
+                heapq.heappush(self._heap, (current, path))
+            else:
+                del self._deadlines[path]
+                expired.append((path, value))
+        return expired
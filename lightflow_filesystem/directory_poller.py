@@ -0,0 +1,235 @@
+import os
+import time
+from itertools import count
+
+import inotify.constants as constants
+
+
+# directories modified less than this number of seconds ago are always listed, since
+# a further change within the timestamp granularity would not alter their mtime
+RACY_INTERVAL = 2.0
+
+
+class DirectoryPoller:
+    """ Detects file changes in directories by comparing periodic snapshots.
+
+    The poller keeps the name, type, size, modification time and inode of every
+    entry of the polled directories. On each poll the directories whose own
+    modification time changed are listed again and the differences to the previous
+    snapshot are turned into inotify style events. Entries that disappeared and
+    reappeared with the same inode, size and modification time are reported as
+    moves. New and changed files are reported as closed once their size and
+    modification time did not change between two polls. Only these unsettled files
+    are checked in directories that did not change, such that the cost of a poll is
+    dominated by the number of changed directories.
+
+    Files that are rewritten in place without changing the directory are not detected
+    unless they are still unsettled.
+    """
+    def __init__(self, interval):
+        """ Initialize the directory poller.
+
+        Args:
+            interval (float): The time in seconds between two polls.
+        """
+        self._interval = interval
+        self._directories = {}
+        self._unsettled = {}
+        self._vanished = {}
+        self._cookies = count(1)
+        self._next_poll = time.monotonic() + interval
+
+    def __len__(self):
+        return len(self._directories)
+
+    def __contains__(self, path):
+        return path in self._directories
+
+    def add_directory(self, path, entries, dir_mtime=None):
+        """ Start polling a directory.
+
+        Args:
+            path (bytes): The path to the directory.
+            entries (list): The os.DirEntry objects of the current directory content,
+                            which form the initial snapshot.
+            dir_mtime (int, None): The modification time of the directory in
+                                   nanoseconds, taken before the entries were
+                                   listed. The directory is only listed again on
+                                   the next poll if it changed since. Set to None
+                                   to always list it on the next poll.
+        """
+        self._directories[path] = (dir_mtime, self._snapshot(entries))
+
+    def remove_directory(self, path):
+        """ Stop polling a directory.
+
+        Args:
+            path (bytes): The path to the directory.
+        """
+        self._directories.pop(path, None)
+        self._unsettled.pop(path, None)
+
+    def snapshot(self, path):
+        """ Return the last snapshot of a directory.
+
+        The snapshot of a directory that disappeared is kept until the next poll,
+        such that it can be handed over to the new path of a renamed directory.
+
+        Args:
+            path (bytes): The path to the directory.
+
+        Returns:
+            tuple: The (is_dir, size, mtime, inode) of each entry keyed by name and
+                   the set of names of the files that were still being written, or
+                   None if the directory is not polled.
+        """
+        if path in self._vanished:
+            return self._vanished[path]
+        if path not in self._directories:
+            return None
+        return self._directories[path][1], set(self._unsettled.get(path, ()))
+
+    def time_to_poll(self):
+        """ Return the time in seconds until the next poll is due. """
+        return max(0.0, self._next_poll - time.monotonic())
+
+    def poll(self):
+        """ Check the polled directories and return the changes since the last poll.
+
+        Returns:
+            list: A list of (mask, cookie, directory, filename) tuples.
+        """
+        self._next_poll = time.monotonic() + self._interval
+        self._vanished.clear()
+
+        events = []
+        created = []
+        deleted = {}
+        for path, (dir_mtime, old) in list(self._directories.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._vanished[path] = self.snapshot(path)
+                self.remove_directory(path)
+                continue
+
+            if stat.st_mtime_ns == dir_mtime and \
+                    time.time() - stat.st_mtime > RACY_INTERVAL:
+                self._check_unsettled(path, old, events)
+                continue
+
+            try:
+                with os.scandir(path) as entries:
+                    new = self._snapshot(entries)
+            except OSError:
+                self._vanished[path] = self.snapshot(path)
+                self.remove_directory(path)
+                continue
+
+            self._compare(path, old, new, events, created, deleted)
+            self._directories[path] = (stat.st_mtime_ns, new)
+
+        self._match_moves(events, created, deleted)
+        return events
+
+    def _compare(self, path, old, new, events, created, deleted):
+        """ Turn the differences between two snapshots of a directory into events. """
+        unsettled = self._unsettled.get(path, set())
+        for name, info in new.items():
+            previous = old.get(name)
+            if previous is None or previous[3] != info[3]:
+                created.append((path, name, info))
+                if previous is not None:
+                    deleted[previous[3]] = (path, name, previous)
+            elif previous != info:
+                if not info[0]:
+                    events.append((constants.IN_MODIFY, 0, path, name))
+                    unsettled.add(name)
+            elif name in unsettled:
+                events.append((constants.IN_CLOSE_WRITE, 0, path, name))
+                unsettled.discard(name)
+
+        for name in old.keys() - new.keys():
+            deleted[old[name][3]] = (path, name, old[name])
+            unsettled.discard(name)
+
+        self._set_unsettled(path, unsettled)
+
+    def _check_unsettled(self, path, snapshot, events):
+        """ Check the files of an unchanged directory that were still being written. """
+        unsettled = self._unsettled.get(path)
+        if not unsettled:
+            return
+
+        for name in list(unsettled):
+            try:
+                stat = os.stat(path + b'/' + name, follow_symlinks=False)
+            except OSError:
+                unsettled.discard(name)
+                continue
+
+            info = (False, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            if snapshot.get(name) == info:
+                events.append((constants.IN_CLOSE_WRITE, 0, path, name))
+                unsettled.discard(name)
+            else:
+                events.append((constants.IN_MODIFY, 0, path, name))
+                snapshot[name] = info
+        self._set_unsettled(path, unsettled)
+
+    def _match_moves(self, events, created, deleted):
+        """ Report entries that were deleted and created with the same inode as moves.
+
+        All other created and deleted entries are reported as such. New files are
+        marked as unsettled.
+        """
+        for path, name, info in created:
+            is_dir = constants.IN_ISDIR if info[0] else 0
+            if self._is_move(deleted.get(info[3]), info):
+                source_path, source_name, _ = deleted.pop(info[3])
+                cookie = next(self._cookies)
+                events.append((constants.IN_MOVED_FROM | is_dir, cookie,
+                               source_path, source_name))
+                events.append((constants.IN_MOVED_TO | is_dir, cookie, path, name))
+            else:
+                events.append((constants.IN_CREATE | is_dir, 0, path, name))
+                if not is_dir:
+                    self._unsettled.setdefault(path, set()).add(name)
+
+        for path, name, info in deleted.values():
+            is_dir = constants.IN_ISDIR if info[0] else 0
+            events.append((constants.IN_DELETE | is_dir, 0, path, name))
+
+    @staticmethod
+    def _is_move(source, info):
+        """ Check whether a deleted entry is the origin of a created entry.
+
+        Inodes are reused after a deletion, therefore files also have to agree in
+        their size and modification time, which are both kept by a rename.
+        """
+        if source is None:
+            return False
+        if info[0]:
+            return source[2][0]
+        return source[2] == info
+
+    def _set_unsettled(self, path, unsettled):
+        """ Store the unsettled files of a directory, dropping empty entries. """
+        if unsettled:
+            self._unsettled[path] = unsettled
+        else:
+            self._unsettled.pop(path, None)
+
+    @staticmethod
+    def _snapshot(entries):
+        """ Return the (is_dir, size, mtime, inode) of each entry, keyed by name. """
+        snapshot = {}
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            snapshot[entry.name] = (is_dir, 0 if is_dir else stat.st_size,
+                                    stat.st_mtime_ns, stat.st_ino)
+        return snapshot
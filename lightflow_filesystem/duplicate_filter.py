@@ -0,0 +1,94 @@
+import time
+from collections import OrderedDict
+
+
+class DuplicateFilter:
+    """ Hash based index of recently seen file paths.
+
+    The filter keeps the most recently seen paths in an ordered dictionary, which
+    allows membership tests, insertions and evictions in constant time. The window of
+    remembered paths can be bounded by the number of entries (least recently seen
+    entries are evicted first) and/or by the time since a path was last seen.
+    """
+    def __init__(self, max_size=None, max_age=None):
+        """ Initialize the duplicate filter.
+
+        Args:
+            max_size (int, None): The maximum number of paths that are remembered.
+                                  Set to None for no limit.
+            max_age (float, None): The time in seconds after which a path is forgotten.
+                                   Set to None for no limit.
+        """
+        self._max_size = max_size
+        self._max_age = max_age
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        self._expire(time.monotonic())
+        return path in self._entries
+
+    def __iter__(self):
+        self._expire(time.monotonic())
+        return iter(list(self._entries))
+
+    def seen(self, path):
+        """ Check whether a path has been seen before and remember it.
+
+        Looking up a path that is already in the window refreshes its position and
+        timestamp, such that a file which keeps being reopened stays suppressed.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            bool: True if the path is already known.
+        """
+        now = time.monotonic()
+        self._expire(now)
+
+        known = path in self._entries
+        if known:
+            self._entries.move_to_end(path)
+        self._entries[path] = now
+
+        if self._max_size is not None:
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return known
+
+    def add(self, paths):
+        """ Remember a list of paths without checking for duplicates.
+
+        Args:
+            paths (list): The list of paths that should be added to the window.
+        """
+        for path in paths:
+            self.seen(path)
+
+    def discard(self, paths):
+        """ Forget a list of paths.
+
+        Args:
+            paths (list): The list of paths that should be removed from the window.
+        """
+        for path in paths:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        """ Forget all paths. """
+        self._entries.clear()
+
+    def _expire(self, now):
+        """ Remove all entries that are older than the maximum age. """
+        if self._max_age is None:
+            return
+
+        threshold = now - self._max_age
+        while self._entries:
+            path, timestamp = next(iter(self._entries.items()))
+            if timestamp > threshold:
+                break
+            self._entries.popitem(last=False)
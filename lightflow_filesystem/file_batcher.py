@@ -0,0 +1,251 @@
+import time
+import heapq
+import itertools
+from collections import deque
+
+
+# the kinds of deadlines of a pending batch
+WAIT = 0
+IDLE = 1
+
+
+class FileBatch(list):
+    """ A list of file paths that is handed to a callback in one go.
+
+    Attributes:
+        root (str, None): The watched root directory the files belong to or None if
+                          the files belong to more than one root directory.
+        group: The group key the files belong to or None if the files were not
+               grouped or belong to more than one group.
+        created (float): The monotonic time at which the oldest file of the batch was
+                         added to the batch.
+    """
+    def __init__(self, files=(), root=None, group=None, created=None):
+        super().__init__(files)
+        self.root = root
+        self.group = group
+        self.created = time.monotonic() if created is None else created
+
+
+class FileBatcher:
+    """ Aggregates file paths into batches that are handed to a callback.
+
+    A batch is ready as soon as it contains the requested number of files, the
+    cumulative size of its files reaches a byte limit, its oldest file has been
+    waiting for longer than the maximum waiting time or no file was added to it for
+    longer than the maximum idle time. Files can be aggregated into separate batches
+    by giving them different keys.
+
+    The keys of the batches that are full are kept in a set and the waiting and idle
+    deadlines in a heap, such that the cost of checking for ready batches does not
+    grow with the number of keys. The deadlines in the heap are updated lazily: a
+    deadline of a key only moves forward, thus an entry is checked against the
+    current deadline of its key once it reaches the top of the heap.
+    """
+    def __init__(self, aggregate=1, max_wait=None, max_bytes=None, max_idle=None):
+        """ Initialize the file batcher.
+
+        Args:
+            aggregate (int): The number of files in a full batch.
+            max_wait (float, None): The maximum time in seconds a file is kept in a
+                                    partial batch before the batch is flushed.
+                                    Set to None to turn off.
+            max_bytes (int, None): The cumulative file size in bytes at which a batch
+                                   is flushed. Set to None to turn off.
+            max_idle (float, None): The time in seconds without a new file after which
+                                    a partial batch is flushed. Set to None to
+                                    turn off.
+        """
+        self._aggregate = max(aggregate, 1)
+        self._max_wait = max_wait
+        self._max_bytes = max_bytes
+        self._max_idle = max_idle
+        self._pending = {}
+        self._bytes = {}
+        self._count = 0
+        self._full = {}
+        self._deadlines = []
+        self._scheduled = {}
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def tracks_size(self):
+        """ bool: True if the file sizes are required for batching. """
+        return self._max_bytes is not None
+
+    def add(self, path, size=0, root=None, group=None, key=None, now=None):
+        """ Add a file to a pending batch.
+
+        Args:
+            path (str): The path of the file.
+            size (int): The size of the file in bytes.
+            root (str, None): The root directory the file belongs to.
+            group: The group key the file belongs to.
+            key: The key of the batch the file is added to.
+            now (float, None): The monotonic time the file was added. Defaults to
+                               the current time.
+        """
+        now = time.monotonic() if now is None else now
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = deque()
+            self._bytes[key] = 0
+
+        pending.append((path, size, root, group, now))
+        self._bytes[key] += size
+        self._count += 1
+
+        if self._is_full(key):
+            self._full[key] = None
+        if self._max_wait is not None and (WAIT, key) not in self._scheduled:
+            self._schedule(WAIT, key, now + self._max_wait)
+        if self._max_idle is not None and (IDLE, key) not in self._scheduled:
+            self._schedule(IDLE, key, now + self._max_idle)
+
+    def next_deadline(self):
+        """ Return the monotonic time at which the first pending batch times out.
+
+        Returns:
+            float: The deadline or None if there is no deadline.
+        """
+        entry = self._first_deadline()
+        return entry[0] if entry is not None else None
+
+    def pop_ready(self, now=None, max_batches=None, max_files=None):
+        """ Remove and return the batches that are ready to be handed over.
+
+        Args:
+            now (float, None): The current monotonic time. Defaults to the current time.
+            max_batches (int, None): The maximum number of batches that are returned.
+                                     Set to None for no limit.
+            max_files (int, None): The maximum number of files of a full batch. Files
+                                   that accumulated beyond the aggregation count are
+                                   returned in batches of up to this size instead
+                                   of the aggregation count. Set to None to always
+                                   use the aggregation count.
+
+        Returns:
+            list: A list of FileBatch objects.
+        """
+        now = time.monotonic() if now is None else now
+        max_files = self._aggregate if max_files is None \
+            else max(max_files, self._aggregate)
+
+        batches = []
+
+        def has_room():
+            return max_batches is None or len(batches) < max_batches
+
+        # the batches that reached the aggregation count or the byte limit
+        for key in list(self._full):
+            if not has_room():
+                break
+
+            pending = self._pending[key]
+            while len(pending) >= self._aggregate and has_room():
+                batches.append(self._pop(key, min(len(pending), max_files)))
+
+            if self._max_bytes is not None:
+                while pending and self._bytes[key] >= self._max_bytes and has_room():
+                    total = 0
+                    for count, (_, size, _, _, _) in enumerate(pending, 1):
+                        total += size
+                        if total >= self._max_bytes:
+                            break
+                    batches.append(self._pop(key, count))
+
+            if not self._is_full(key):
+                del self._full[key]
+            if not pending:
+                self._discard(key)
+
+        # the partial batches that waited too long
+        while has_room():
+            entry = self._first_deadline()
+            if entry is None or entry[0] > now:
+                break
+
+            key = entry[3]
+            batches.append(self._pop(key, len(self._pending[key])))
+            self._discard(key)
+
+        return batches
+
+    def pop(self, key):
+        """ Remove and return the pending batch of a key regardless of its size.
+
+        Args:
+            key: The key of the batch.
+
+        Returns:
+            FileBatch: The batch or None if no files are pending for the key.
+        """
+        if key not in self._pending:
+            return None
+
+        batch = self._pop(key, len(self._pending[key]))
+        self._discard(key)
+        return batch
+
+    def _pop(self, key, count):
+        """ Remove the given number of files from the front of a pending batch. """
+        pending = self._pending[key]
+        batch = FileBatch(created=pending[0][4])
+        roots = set()
+        groups = set()
+        for _ in range(count):
+            path, size, root, group, _ = pending.popleft()
+            self._bytes[key] -= size
+            batch.append(path)
+            roots.add(root)
+            groups.add(group)
+        self._count -= count
+        batch.root = roots.pop() if len(roots) == 1 else None
+        batch.group = groups.pop() if len(groups) == 1 else None
+        return batch
+
+    def _discard(self, key):
+        """ Forget an empty pending batch and its deadlines. """
+        del self._pending[key]
+        del self._bytes[key]
+        self._full.pop(key, None)
+        self._scheduled.pop((WAIT, key), None)
+        self._scheduled.pop((IDLE, key), None)
+
+    def _is_full(self, key):
+        """ Check whether a batch reached the aggregation count or the byte limit. """
+        return len(self._pending[key]) >= self._aggregate or \
+            (self._max_bytes is not None and self._pending[key] and
+             self._bytes[key] >= self._max_bytes)
+
+    def _deadline(self, kind, key):
+        """ Return the current waiting or idle deadline of a pending batch. """
+        pending = self._pending[key]
+        if kind == WAIT:
+            return pending[0][4] + self._max_wait
+        return pending[-1][4] + self._max_idle
+
+    def _schedule(self, kind, key, deadline):
+        """ Push a deadline of a key onto the heap, replacing its previous entry. """
+        sequence = next(self._sequence)
+        self._scheduled[(kind, key)] = sequence
+        heapq.heappush(self._deadlines, (deadline, sequence, kind, key))
+
+    def _first_deadline(self):
+        """ Return the heap entry of the earliest current deadline or None. """
+        while self._deadlines:
+            deadline, sequence, kind, key = self._deadlines[0]
+            if self._scheduled.get((kind, key)) != sequence:
+                heapq.heappop(self._deadlines)
+                continue
+
+            current = self._deadline(kind, key)
+            if current > deadline:
+                heapq.heappop(self._deadlines)
+                self._schedule(kind, key, current)
+                continue
+            return self._deadlines[0]
+        return None
@@ -0,0 +1,89 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .exceptions import LightflowFilesystemConfigError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# the columns of the stat figures of a list of files
+STAT_DTYPE = [('path', 'i8'), ('size', 'i8'), ('mtime', 'f8'),
+              ('uid', 'u4'), ('mode', 'u4')]
+
+# the paths of a list of files and a NumPy structured array of their stat figures,
+# whose path column is the index of each file among all collected files
+FileColumns = namedtuple('FileColumns', ['paths', 'stats'])
+
+
+class StatCollector:
+    """ Collects the stat figures of lists of files into NumPy structured arrays.
+
+    The figures are taken with lstat, optionally by a pool of threads, which pays
+    off on filesystems with a high latency. Each file is given an index that counts
+    the files across all lists, such that the arrays of several lists can be
+    concatenated. Files that no longer exist when their figures are taken are
+    dropped. Requires NumPy, which is installed with the 'numpy' extra.
+    """
+    def __init__(self, workers=None):
+        """ Initialize the stat collector.
+
+        Args:
+            workers (int, None): The number of threads that stat the files. Set to
+                                 None to stat the files in the calling thread.
+
+        Raises:
+            LightflowFilesystemConfigError: If NumPy is not installed.
+        """
+        if numpy is None:
+            raise LightflowFilesystemConfigError(
+                'Collecting stat figures into columns requires numpy')
+
+        self._pool = ThreadPoolExecutor(max_workers=workers) \
+            if workers is not None else None
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def collect(self, entries):
+        """ Stat a list of files and return their figures as columns.
+
+        Args:
+            entries (list): The os.DirEntry objects of the files.
+
+        Returns:
+            FileColumns: The paths and the structured array of the stat figures.
+        """
+        if self._pool is not None:
+            stats = self._pool.map(self._lstat, entries)
+        else:
+            stats = map(self._lstat, entries)
+
+        found = [(entry, stat) for entry, stat in zip(entries, stats)
+                 if stat is not None]
+        array = numpy.array([(index, stat.st_size, stat.st_mtime, stat.st_uid,
+                              stat.st_mode)
+                             for index, (_, stat) in enumerate(found, self._count)],
+                            dtype=STAT_DTYPE)
+        self._count += len(array)
+        return FileColumns([entry.path for entry, _ in found], array)
+
+    def close(self):
+        """ Stop the threads. """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    @staticmethod
+    def _lstat(entry):
+        """ Return the lstat result of a file or None if it no longer exists. """
+        try:
+            return entry.stat(follow_symlinks=False)
+        except OSError:
+            return None
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import threading
+
+
+class FileJournal:
+    """ Persistent record of the files that have been handed to a callback.
+
+    The journal is stored in a SQLite database, using the file path as the primary
+    key, such that lookups stay fast for millions of entries. A file is identified
+    by its path, size and modification time, thus a file that has been modified since
+    it was recorded is not regarded as known. The journal can be shared between
+    threads.
+    """
+    def __init__(self, path):
+        """ Open or create the journal.
+
+        Args:
+            path (str): The path to the journal database file.
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                 'path BLOB PRIMARY KEY, size INTEGER, mtime INTEGER'
+                                 ') WITHOUT ROWID')
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def contains(self, path, size, mtime):
+        """ Check whether a file with the given size and mtime has been recorded.
+
+        Args:
+            path (str): The path of the file.
+            size (int): The size of the file in bytes.
+            mtime (int): The modification time of the file in nanoseconds.
+
+        Returns:
+            bool: True if the file is known.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime FROM files WHERE path = ?',
+                (os.fsencode(path),)).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    def record(self, entries):
+        """ Record a list of files in a single transaction.
+
+        Args:
+            entries (list): A list of (path, size, mtime) tuples, with the mtime
+                            given in nanoseconds.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                ((os.fsencode(path), size, mtime) for path, size, mtime in entries))
+
+    def close(self):
+        """ Close the journal database. """
+        with self._lock:
+            self._connection.close()
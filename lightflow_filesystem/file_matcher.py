@@ -0,0 +1,86 @@
+import os
+import re
+from fnmatch import translate
+
+
+# globs that only test the extension, such as '*.h5', are checked without a regex
+EXTENSION_GLOB = re.compile(r'^\*(\.[^*?\[\]/]+)$')
+
+
+class FileMatcher:
+    """ Decides whether a file is of interest based on its name.
+
+    The include and exclude patterns are compiled once into a tuple of extensions,
+    which is checked with bytes.endswith(), and a single regular expression for the
+    remaining patterns. The patterns are matched against the raw bytes of the file
+    name, such that names can be filtered before they are decoded or joined with
+    their directory.
+
+    Patterns are either globs, such as '*.h5' or 'image_*.cbf', or regular
+    expressions prefixed by 're:', such as 're:^tmp_\\d+'. Regular expressions are
+    searched for anywhere in the name, globs have to match the whole name.
+    """
+    def __init__(self, include=None, exclude=None):
+        """ Initialize the file matcher.
+
+        Args:
+            include (str, list, None): A pattern or a list of patterns of which a name
+                                       has to match at least one. Set to None to
+                                       include all names.
+            exclude (str, list, None): A pattern or a list of patterns of which a name
+                                       must not match any. Set to None to exclude no
+                                       names.
+        """
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+
+    def __call__(self, name):
+        return self.matches(name)
+
+    def matches(self, name):
+        """ Check whether a name is included and not excluded.
+
+        Args:
+            name (bytes): The name of the file or directory without its path.
+
+        Returns:
+            bool: True if the name matches the patterns.
+        """
+        if self._include is not None and not self._test(self._include, name):
+            return False
+        return self._exclude is None or not self._test(self._exclude, name)
+
+    @staticmethod
+    def _test(compiled, name):
+        """ Check whether a name matches one of the compiled patterns. """
+        extensions, regex = compiled
+        if extensions and name.endswith(extensions):
+            return True
+        return regex is not None and regex.search(name) is not None
+
+    @staticmethod
+    def _compile(patterns):
+        """ Return a tuple of extensions and a combined regex for a list of patterns. """
+        if patterns is None:
+            return None
+        if isinstance(patterns, (str, bytes)):
+            patterns = [patterns]
+
+        extensions = []
+        expressions = []
+        for pattern in patterns:
+            pattern = os.fsdecode(pattern)
+            if pattern.startswith('re:'):
+                expressions.append(pattern[3:])
+                continue
+
+            extension = EXTENSION_GLOB.match(pattern)
+            if extension is not None:
+                extensions.append(os.fsencode(extension.group(1)))
+            else:
+                expressions.append(r'\A' + translate(pattern))
+
+        regex = re.compile(os.fsencode('|'.join('(?:{})'.format(expression)
+                                                for expression in expressions))) \
+            if expressions else None
+        return tuple(extensions), regex
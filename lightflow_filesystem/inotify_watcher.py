@@ -0,0 +1,463 @@
+import os
+import select
+import struct
+import time
+from collections import deque, OrderedDict
+
+import inotify.calls
+import inotify.constants as constants
+
+from .directory_poller import DirectoryPoller
+
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# the directory events that are required to keep track of a recursive watch
+TREE_MASK = (constants.IN_CREATE | constants.IN_DELETE | constants.IN_MOVE |
+             constants.IN_DELETE_SELF | constants.IN_ONLYDIR)
+
+# the reasons for registering a directory: being part of the initial tree, having been
+# created or moved into the tree later on, having been renamed within the tree or
+# being rescanned after events were lost
+REGISTER_INITIAL = 0
+REGISTER_CREATED = 1
+REGISTER_MOVED = 2
+REGISTER_RESCAN = 3
+
+# the kernel limit for the number of events in the queue of an inotify instance
+MAX_QUEUED_EVENTS_PATH = '/proc/sys/fs/inotify/max_queued_events'
+
+# the number of directory renames that are remembered for matching their cookies
+MAX_MOVE_COOKIES = 1024
+
+
+class InotifyWatcher:
+    """ Reads inotify events in batches from a single inotify file descriptor.
+
+    The file descriptor is read in non-blocking mode into a preallocated buffer until
+    the kernel queue is drained, such that all pending events are returned with as
+    few system calls as possible.
+
+    Directories can be watched recursively. The watches of the subdirectories are
+    registered lazily in chunks by calling register_pending(), which allows events
+    to be processed while a large tree is still being registered. Subdirectories that
+    are created later on are registered the same way. Once the watch budget is used
+    up, or the kernel refuses further watches, directories are polled instead.
+    Subdirectories whose name is rejected by the directory filter are neither
+    watched nor polled, together with their whole subtree.
+
+    If the kernel queue overflowed, all watched trees are queued for a rescan. A
+    directory that lost its watch while it still exists, for example because it was
+    replaced by a new directory of the same name, is registered again. A watched
+    root directory that was removed is registered again once it reappears.
+    """
+    def __init__(self, max_watches=None, poll_interval=5.0, buffer_size=65536,
+                 directory_filter=None):
+        """ Initialize the inotify watcher.
+
+        Args:
+            max_watches (int, None): The maximum number of inotify watches. Directories
+                                     beyond this number are polled. Set to None to
+                                     only be limited by the kernel and to 0 to poll
+                                     all directories.
+            poll_interval (float): The time in seconds between two polls of the
+                                   directories that could not be watched.
+            buffer_size (int): The size of the read buffer in bytes.
+            directory_filter (callable, None): A callable that is called with the
+                                               name of a subdirectory as bytes and
+                                               returns False if the subdirectory
+                                               should not be watched. Set to None to
+                                               watch all subdirectories.
+        """
+        self._fd = inotify.calls.inotify_init()
+        os.set_blocking(self._fd, False)
+
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+
+        self._max_watches = max_watches
+        self._directory_filter = directory_filter
+        self._poller = DirectoryPoller(poll_interval)
+
+        self._watches = {}
+        self._paths = {}
+        self._polled = {}
+        self._children = {}
+        self._roots = {}
+        self._lost_roots = {}
+        self._pending = deque()
+        self._queued = set()
+        self._move_cookies = OrderedDict()
+        self._moved = {}
+        self._overflows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._watches)
+
+    @property
+    def pending(self):
+        """ int: The number of directories that are waiting to be registered. """
+        return len(self._pending)
+
+    @property
+    def polled(self):
+        """ int: The number of directories that are polled instead of watched. """
+        return len(self._poller)
+
+    @property
+    def overflows(self):
+        """ int: The number of times the kernel event queue overflowed. """
+        return self._overflows
+
+    def add_watch(self, path, mask, recursive=False, tag=None):
+        """ Watch a directory for filesystem events.
+
+        The directory itself is registered immediately, its subdirectories are
+        queued for registration.
+
+        Args:
+            path (bytes): The absolute path to the directory.
+            mask (int): The inotify event mask.
+            recursive (bool): Also watch all subdirectories, including subdirectories
+                              that are created later on.
+            tag: An arbitrary object that is passed along with all events and
+                 registrations of this directory and its subdirectories.
+
+        Returns:
+            list: The registered directory, as returned by register_pending().
+        """
+        mask = mask | TREE_MASK if recursive else mask
+        self._roots[path] = (path, mask, recursive, tag)
+        return [self._register(path, mask, recursive, REGISTER_INITIAL, tag)]
+
+    def register_pending(self, count):
+        """ Register a number of directories that are waiting for their watch.
+
+        Each directory is listed after its watch has been added. Files that are
+        changed after the registration time trigger an event, files that are only
+        part of the listing might have been changed before.
+
+        Args:
+            count (int): The maximum number of directories that are registered.
+
+        Returns:
+            list: A list of (path, registration_time, files, origin, tag) tuples,
+                  with files being the os.DirEntry objects of the files in the
+                  directory and origin being one of REGISTER_INITIAL,
+                  REGISTER_CREATED, REGISTER_MOVED or REGISTER_RESCAN. Only the
+                  watched directories of a renamed subtree are registered as
+                  REGISTER_MOVED. Its polled directories are registered as
+                  REGISTER_CREATED with the files that changed since their last
+                  poll and its directories that were not registered yet with all
+                  their files, since these were never reported.
+        """
+        registered = []
+        while self._pending and len(registered) < count:
+            entry = self._pending.popleft()
+            self._queued.discard(entry[0])
+            try:
+                registered.append(self._register(*entry))
+            except (OSError, inotify.calls.InotifyError):
+                continue
+        return registered
+
+    def rescan(self):
+        """ Queue all watched root directories and their subtrees for a rescan. """
+        for path, mask, recursive, tag in self._roots.values():
+            if path not in self._lost_roots:
+                self._queue((path, mask, recursive, REGISTER_RESCAN, tag))
+
+    def remove_watch(self, path):
+        """ Stop watching a directory and, if watched recursively, its subdirectories.
+
+        Args:
+            path (bytes): The absolute path to the directory.
+        """
+        stack = [path]
+        while stack:
+            dir_path = stack.pop()
+            stack.extend(self._children.pop(dir_path, ()))
+
+            wd = self._paths.get(dir_path)
+            if wd is not None:
+                self._remove(wd, kernel=True)
+            if self._polled.pop(dir_path, None) is not None:
+                self._poller.remove_directory(dir_path)
+            self._forget(dir_path)
+
+    def read_events(self, timeout=None):
+        """ Wait for events and return all events that are pending.
+
+        Args:
+            timeout (float, None): The maximum time in seconds to wait for events.
+                                   Set to None to block until events arrive.
+
+        Returns:
+            list: A list of (mask, cookie, watch_path, filename, tag) tuples, where
+                  watch_path is the watched directory and filename the name of the
+                  file relative to it. Both are bytes. The watch_path and tag are
+                  None for events that do not belong to a watch.
+        """
+        if self._polled or self._lost_roots:
+            time_to_poll = self._poller.time_to_poll()
+            timeout = time_to_poll if timeout is None else min(timeout, time_to_poll)
+
+        events = []
+        try:
+            ready = self._poll.poll(None if timeout is None else timeout * 1000)
+        except InterruptedError:
+            ready = None
+
+        while ready:
+            try:
+                length = os.readv(self._fd, [self._buffer])
+            except BlockingIOError:
+                break
+            if length <= 0:
+                break
+            self._parse(length, events)
+
+        if (self._polled or self._lost_roots) and self._poller.time_to_poll() <= 0.0:
+            self._restore_roots()
+            for event_mask, cookie, watch_path, filename in self._poller.poll():
+                watch = self._polled.get(watch_path)
+                if watch is None:
+                    continue
+
+                events.append((event_mask, cookie, watch_path, filename, watch[3]))
+                if event_mask & constants.IN_ISDIR:
+                    self._update_tree(event_mask, cookie, filename, *watch)
+
+            # forget the directories that disappeared since the last poll
+            for path in list(self._polled):
+                if path not in self._poller:
+                    del self._polled[path]
+                    self._forget(path)
+                    if path in self._roots:
+                        self._lost_roots[path] = self._roots[path]
+        return events
+
+    def close(self):
+        """ Remove all watches and close the inotify file descriptor. """
+        if self._fd is None:
+            return
+        self._poll.unregister(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self._watches.clear()
+        self._paths.clear()
+        self._polled.clear()
+        self._children.clear()
+        self._moved.clear()
+        self._pending.clear()
+        self._queued.clear()
+
+    def _parse(self, length, events):
+        """ Decode the events in the read buffer and update the recursive watches. """
+        view = self._view
+        offset = 0
+        while offset < length:
+            wd, mask, cookie, name_length = EVENT_HEADER.unpack_from(view, offset)
+            offset += EVENT_HEADER.size
+            filename = bytes(view[offset:offset + name_length]).split(b'\0', 1)[0]
+            offset += name_length
+
+            watch = self._watches.get(wd)
+            if watch is None:
+                events.append((mask, cookie, None, filename, None))
+                if mask & constants.IN_Q_OVERFLOW:
+                    self._overflows += 1
+                    self.rescan()
+                continue
+
+            events.append((mask, cookie, watch[0], filename, watch[3]))
+            if mask & constants.IN_IGNORED:
+                self._remove(wd, kernel=False)
+                self._restore(*watch)
+            elif mask & constants.IN_ISDIR:
+                self._update_tree(mask, cookie, filename, *watch)
+
+    def _update_tree(self, mask, cookie, filename, path, watch_mask, recursive, tag):
+        """ Follow the creation, removal and renaming of subdirectories. """
+        if not recursive:
+            return
+
+        dir_path = path + b'/' + filename
+        if mask & (constants.IN_CREATE | constants.IN_MOVED_TO) and \
+                not self._is_included(filename):
+            return
+
+        if mask & constants.IN_CREATE:
+            self._queue((dir_path, watch_mask, True, REGISTER_CREATED, tag), first=True)
+        elif mask & constants.IN_MOVED_TO:
+            snapshots = self._move_cookies.pop(cookie, None)
+            if snapshots is not None:
+                for relative_path, snapshot in snapshots.items():
+                    self._moved[dir_path + relative_path] = snapshot
+            origin = REGISTER_MOVED if snapshots is not None else REGISTER_CREATED
+            self._queue((dir_path, watch_mask, True, origin, tag), first=True)
+        elif mask & constants.IN_MOVED_FROM:
+            # the watches of a deleted subtree are dropped by the kernel, which is
+            # reported by IN_IGNORED, but a moved subtree keeps its watches. The
+            # snapshots of its polled directories are handed over to the new path.
+            self._move_cookies[cookie] = self._moved_snapshots(dir_path)
+            while len(self._move_cookies) > MAX_MOVE_COOKIES:
+                self._move_cookies.popitem(last=False)
+            self.remove_watch(dir_path)
+
+    def _register(self, path, mask, recursive, origin, tag):
+        """ Watch or poll a single directory and queue its subdirectories. """
+        registered = origin == REGISTER_MOVED and path in self._moved
+        snapshot = self._moved.pop(path, None)
+        registration_time = time.time()
+        if path in self._paths or self._max_watches is None or \
+                len(self._watches) < self._max_watches:
+            try:
+                wd = inotify.calls.inotify_add_watch(self._fd, path, mask)
+            except inotify.calls.InotifyError:
+                if not os.path.isdir(path):
+                    raise
+                wd = None
+        else:
+            wd = None
+
+        # a polled directory is only listed again once its mtime changed
+        dir_mtime = os.stat(path).st_mtime_ns if wd is None else None
+        with os.scandir(path) as iterator:
+            entries = list(iterator)
+
+        if wd is not None:
+            self._watches[wd] = (path, mask, recursive, tag)
+            self._paths[path] = wd
+            if self._polled.pop(path, None) is not None:
+                self._poller.remove_directory(path)
+        else:
+            self._polled[path] = (path, mask, recursive, tag)
+            self._poller.add_directory(path, entries, dir_mtime)
+        if path not in self._roots:
+            self._children.setdefault(os.path.dirname(path), set()).add(path)
+
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if not is_dir:
+                files.append(entry)
+            elif recursive and self._is_included(entry.name):
+                self._queue((entry.path, mask, recursive, origin, tag))
+
+        if origin == REGISTER_MOVED and (snapshot is not None or not registered):
+            if snapshot is not None:
+                files = self._changed_files(files, *snapshot)
+            origin = REGISTER_CREATED
+        return path, registration_time, files, origin, tag
+
+    def _moved_snapshots(self, path):
+        """ Return the snapshots of the registered directories of a subtree.
+
+        Returns:
+            dict: The snapshot of each registered directory, as returned by
+                  DirectoryPoller.snapshot(), or None if it is watched, keyed by its
+                  path relative to the subtree.
+        """
+        snapshots = {}
+        stack = [path]
+        while stack:
+            dir_path = stack.pop()
+            stack.extend(self._children.get(dir_path, ()))
+            if dir_path in self._paths or dir_path in self._polled:
+                snapshots[dir_path[len(path):]] = self._poller.snapshot(dir_path)
+        return snapshots
+
+    @staticmethod
+    def _changed_files(files, snapshot, unsettled):
+        """ Return the files that are new or changed compared to a snapshot. """
+        changed = []
+        for entry in files:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            info = (False, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            if entry.name in unsettled or snapshot.get(entry.name) != info:
+                changed.append(entry)
+        return changed
+
+    def _queue(self, entry, first=False):
+        """ Queue a directory for registration, unless it is queued already. """
+        if entry[0] in self._queued:
+            return
+        self._queued.add(entry[0])
+        if first:
+            self._pending.appendleft(entry)
+        else:
+            self._pending.append(entry)
+
+    def _restore(self, path, mask, recursive, tag):
+        """ Register a directory again whose watch was removed by the kernel.
+
+        A directory that still exists has been replaced, thus all of its files are
+        new. A root directory that does not exist anymore is registered again once
+        it reappears.
+        """
+        if os.path.isdir(path):
+            self._queue((path, mask, recursive, REGISTER_CREATED, tag), first=True)
+        elif path in self._roots:
+            self._lost_roots[path] = self._roots[path]
+
+    def _restore_roots(self):
+        """ Register the root directories again that reappeared. """
+        for path, mask, recursive, tag in list(self._lost_roots.values()):
+            if os.path.isdir(path):
+                del self._lost_roots[path]
+                self._queue((path, mask, recursive, REGISTER_CREATED, tag), first=True)
+
+    def _is_included(self, name):
+        """ Check whether a subdirectory passes the directory filter. """
+        return self._directory_filter is None or self._directory_filter(name)
+
+    def _remove(self, wd, kernel):
+        """ Forget a watch and, if requested, remove it from the kernel. """
+        watch = self._watches.pop(wd, None)
+        if watch is not None and self._paths.get(watch[0]) == wd:
+            del self._paths[watch[0]]
+            self._forget(watch[0])
+        if kernel:
+            try:
+                inotify.calls.inotify_rm_watch(self._fd, wd)
+            except inotify.calls.InotifyError:
+                pass
+
+    def _forget(self, path):
+        """ Remove a directory from the subdirectories of its parent directory. """
+        parent = os.path.dirname(path)
+        children = self._children.get(parent)
+        if children is not None:
+            children.discard(path)
+            if not children:
+                del self._children[parent]
+
+
+def max_queued_events():
+    """ Return the kernel limit for the number of queued events of an inotify instance.
+
+    Returns:
+        int: The limit or None if it is not available.
+    """
+    try:
+        with open(MAX_QUEUED_EVENTS_PATH) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return None
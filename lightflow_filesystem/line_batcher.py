@@ -0,0 +1,155 @@
+class LineBatch(list):
+    """ A list of lines that is handed to a callback in one go.
+
+    Attributes:
+        path (str, None): The path of the file the lines were read from or None if
+                          the lines were read from more than one file.
+        sources (list): The path of the file each line was read from, in the order
+                        of the lines.
+        offsets (dict): The byte offset behind the last line of the batch for each
+                        file the lines were read from. Empty if offsets are not
+                        tracked.
+    """
+    def __init__(self, lines=(), path=None, offsets=None, sources=None):
+        super().__init__(lines)
+        self.path = path
+        self.sources = sources if sources is not None else [path] * len(self)
+        self.offsets = offsets if offsets is not None else {}
+
+
+class LineBatcher:
+    """ Aggregates the lines read from one or more files into batches.
+
+    Lines are added as whole blocks and handed out as batches of the aggregation
+    count. The lines of all files are aggregated into the same batches, unless the
+    lines are aggregated per file. The byte offset behind each line can be tracked,
+    such that the offset of each file up to which the lines have been handed out is
+    known.
+    """
+    def __init__(self, aggregate=1, per_file=False, track_offsets=False):
+        """ Initialize the line batcher.
+
+        Args:
+            aggregate (int): The number of lines in a full batch.
+            per_file (bool): Aggregate the lines of each file separately.
+            track_offsets (bool): Keep the byte offset behind each line.
+        """
+        self._aggregate = max(aggregate, 1)
+        self._per_file = per_file
+        self._track_offsets = track_offsets
+        self._pending = {}
+
+    def __len__(self):
+        return sum(len(pending.lines) for pending in self._pending.values())
+
+    def add(self, path, lines, offsets=None):
+        """ Add the lines read from a file.
+
+        Args:
+            path (str): The path of the file.
+            lines (list): The lines read from the file.
+            offsets (list, None): The byte offset behind each line. Only used if
+                                  offsets are tracked.
+        """
+        key = path if self._per_file else None
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _PendingLines(path)
+
+        if not pending.lines:
+            pending.path = path
+            pending.sources.clear()
+        elif pending.path is not None and pending.path != path:
+            # from now on the source of each line has to be stored
+            pending.sources.extend([pending.path] * len(pending.lines))
+            pending.path = None
+
+        pending.lines.extend(lines)
+        if self._track_offsets:
+            pending.offsets.extend(offsets)
+        if pending.path is None:
+            pending.sources.extend([path] * len(lines))
+
+    def pop_ready(self):
+        """ Remove and return all full batches.
+
+        Returns:
+            list: A list of LineBatch objects.
+        """
+        batches = []
+        for pending in self._pending.values():
+            count = len(pending.lines)
+            batches.extend(pending.pop(count - count % self._aggregate,
+                                       self._aggregate))
+        return batches
+
+    def pop_all(self):
+        """ Remove and return all pending lines regardless of the aggregation count.
+
+        Returns:
+            list: A list of LineBatch objects, one per file if the lines are
+                  aggregated per file, otherwise a single one.
+        """
+        batches = []
+        for pending in self._pending.values():
+            count = len(pending.lines)
+            batches.extend(pending.pop(count, count))
+        return batches
+
+    def reset_offsets(self, path):
+        """ Set the offsets of the pending lines of a file to the beginning of the file.
+
+        Used after a file has been replaced, since the offsets of its pending lines
+        then no longer refer to the file at the path.
+
+        Args:
+            path (str): The path of the file.
+        """
+        if not self._track_offsets:
+            return
+
+        for pending in self._pending.values():
+            if pending.path == path:
+                pending.offsets[:] = [0] * len(pending.offsets)
+            elif pending.path is None:
+                pending.offsets[:] = [0 if source == path else offset
+                                      for source, offset in zip(pending.sources,
+                                                                pending.offsets)]
+
+
+class _PendingLines:
+    """ The lines that are waiting to be handed out in a batch.
+
+    The source of each line is only stored once lines of more than one file were
+    added, otherwise all lines belong to the file given by path.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+        self.offsets = []
+        self.sources = []
+
+    def pop(self, count, size):
+        """ Remove the first count lines and return them in batches of size lines. """
+        if count <= 0:
+            return []
+
+        batches = []
+        for start in range(0, count, size):
+            stop = min(start + size, count)
+            batch = LineBatch(self.lines[start:stop], path=self.path)
+            if self.sources:
+                sources = self.sources[start:stop]
+                paths = set(sources)
+                batch.path = paths.pop() if len(paths) == 1 else None
+                batch.sources = sources
+                if self.offsets:
+                    batch.offsets = dict(zip(sources, self.offsets[start:stop]))
+            elif self.offsets:
+                batch.offsets = {self.path: self.offsets[stop - 1]}
+            batches.append(batch)
+
+        del self.lines[0:count]
+        del self.offsets[0:count]
+        del self.sources[0:count]
+        return batches
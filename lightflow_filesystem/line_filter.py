@@ -0,0 +1,147 @@
+import re
+import csv
+import json
+from operator import not_
+from itertools import compress
+
+from lightflow.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+# the formats into which lines can be parsed
+PARSE_JSON = 'json'
+PARSE_CSV = 'csv'
+PARSE_KV = 'kv'
+PARSERS = (PARSE_JSON, PARSE_CSV, PARSE_KV)
+
+# a key=value pair, whose value is either double quoted or ends at a whitespace
+KEY_VALUE = re.compile(r'([^\s=]+)=(?:"([^"]*)"|(\S*))')
+
+
+class LineFilter:
+    """ Selects the lines of interest and parses them into records.
+
+    The filter is applied to a whole list of lines at once. The include and exclude
+    regular expressions are each combined into a single compiled regular expression,
+    which is searched for in every line, and the lines are selected without running
+    Python code for each line. The selected lines can then be parsed into records:
+
+        json: each line is a JSON document.
+        csv: each line is a row of comma separated values, which is turned into a
+             list or, if field names are given, into a dictionary.
+        kv: each line contains key=value pairs, which are turned into a dictionary.
+            Values containing whitespace have to be double quoted.
+
+    Lines that cannot be parsed are dropped and logged.
+    """
+    def __init__(self, include=None, exclude=None, parse=None, fields=None,
+                 delimiter=','):
+        """ Initialize the line filter.
+
+        Args:
+            include (str, list, None): A regular expression or a list of regular
+                                       expressions of which a line has to match at
+                                       least one. Set to None to include all lines.
+            exclude (str, list, None): A regular expression or a list of regular
+                                       expressions of which a line must not match
+                                       any. Set to None to exclude no lines.
+            parse (str, None): The format of the lines, one of 'json', 'csv' or 'kv'.
+                               Set to None to keep the lines as they are.
+            fields (list, None): The field names of the csv columns.
+            delimiter (str): The delimiter of the csv columns.
+        """
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+        self._parse = parse
+        self._fields = fields
+        self._delimiter = delimiter
+
+    @property
+    def is_active(self):
+        """ bool: True if lines are filtered or parsed. """
+        return self._include is not None or self._exclude is not None or \
+            self._parse is not None
+
+    def apply(self, lines, offsets=None):
+        """ Select and parse a list of lines.
+
+        Args:
+            lines (list): The lines including their line breaks.
+            offsets (list, None): The byte offset behind each line, which is reduced
+                                  to the selected lines.
+
+        Returns:
+            tuple: The list of selected lines or parsed records and the list of
+                   their offsets or None if no offsets were given.
+        """
+        if self._include is not None:
+            lines, offsets = self._select(
+                lines, offsets, list(map(self._include.search, lines)))
+        if self._exclude is not None:
+            lines, offsets = self._select(
+                lines, offsets, list(map(not_, map(self._exclude.search, lines))))
+
+        if self._parse is None or not lines:
+            return lines, offsets
+
+        try:
+            return self._parse_lines(lines), offsets
+        except ValueError:
+            pass
+
+        # parse the lines one by one in order to drop the ones that are malformed
+        records = []
+        selected = []
+        for line in lines:
+            try:
+                records.extend(self._parse_lines([line]))
+                selected.append(True)
+            except ValueError:
+                selected.append(False)
+
+        logger.warning('Dropped {} lines that could not be parsed as {}'.format(
+            selected.count(False), self._parse))
+        if offsets is not None:
+            offsets = list(compress(offsets, selected))
+        return records, offsets
+
+    def _parse_lines(self, lines):
+        """ Parse a list of lines into records.
+
+        Raises:
+            ValueError: If a line cannot be parsed.
+        """
+        if self._parse == PARSE_JSON:
+            return list(map(json.loads, lines))
+
+        if self._parse == PARSE_CSV:
+            try:
+                rows = list(csv.reader(lines, delimiter=self._delimiter))
+            except csv.Error as e:
+                raise ValueError(str(e))
+            if len(rows) != len(lines):
+                raise ValueError('A line contains more than one csv row')
+            if self._fields is None:
+                return rows
+            return [dict(zip(self._fields, row)) for row in rows]
+
+        return [{key: quoted or value for key, quoted, value in pairs}
+                for pairs in map(KEY_VALUE.findall, lines)]
+
+    @staticmethod
+    def _select(lines, offsets, selected):
+        """ Reduce the lines and their offsets to the selected ones. """
+        lines = list(compress(lines, selected))
+        if offsets is not None:
+            offsets = list(compress(offsets, selected))
+        return lines, offsets
+
+    @staticmethod
+    def _compile(patterns):
+        """ Combine a list of regular expressions into a single compiled one. """
+        if patterns is None:
+            return None
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        return re.compile('|'.join('(?:{})'.format(pattern) for pattern in patterns))
@@ -0,0 +1,273 @@
+import os
+import json
+import mmap
+import codecs
+from itertools import accumulate, chain
+
+from lightflow.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class LineReader:
+    """ Reads the complete lines that are appended to a file and tracks their offset.
+
+    The file is read in binary mode in large blocks into a reusable buffer. Each block
+    is split at its last line break, the complete lines are decoded in one go by an
+    incremental decoder and the incomplete last line is carried over to the next
+    read. The byte offset behind the last complete line is kept, such that reading
+    can be resumed at exactly this position, for example after a restart.
+
+    Once the end of the file is reached, check_rotation() detects whether the file
+    was truncated, in which case reading starts again at the beginning, or whether
+    the path now points to a different file, for example after a log rotation by
+    renaming, in which case the new file is read from its beginning.
+
+    The content that already exists when the file is opened can be read in chunks of
+    a given number of lines by read_backlog(), which scans a memory map of the file
+    instead of reading it, such that large files are never held in memory at once.
+
+    Lines are split at b'\\n', thus the encoding has to be ASCII compatible.
+    """
+    def __init__(self, path, encoding='utf-8', errors='strict', block_size=1048576):
+        """ Initialize the line reader.
+
+        Args:
+            path (str): The path to the file.
+            encoding (str): The encoding of the file.
+            errors (str): The handling of decoding errors, as for bytes.decode().
+            block_size (int): The maximum number of bytes read at once.
+        """
+        self._path = path
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self._file = None
+        self._identity = None
+        self._buffer = bytearray(block_size)
+        self._view = memoryview(self._buffer)
+        self._partial = bytearray()
+        self._orphan = None
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def size(self):
+        """ int: The current size of the open file in bytes. """
+        return os.fstat(self._file.fileno()).st_size
+
+    def open(self, offset=None, identity=None):
+        """ Open the file and move to the given offset.
+
+        Args:
+            offset (int, None): The byte offset at which reading starts. Set to None
+                                to start at the end of the file.
+            identity (tuple, None): The (device, inode) the offset refers to. If the
+                                    file is a different file or shorter than the
+                                    offset, reading starts at the beginning.
+        """
+        self._file = open(self._path, 'rb', buffering=0)
+        stat = os.fstat(self._file.fileno())
+        self._identity = (stat.st_dev, stat.st_ino)
+
+        if offset is None:
+            offset = stat.st_size
+        elif (identity is not None and tuple(identity) != self._identity) or \
+                offset > stat.st_size:
+            logger.info('The file {} changed since the offset was taken, '
+                        'reading it from the beginning'.format(self._path))
+            offset = 0
+
+        self._file.seek(offset)
+        self._reset(offset)
+
+    def read_lines(self, with_offsets=False):
+        """ Read the next block and return its complete lines.
+
+        Args:
+            with_offsets (bool): Also return the byte offset behind each line.
+
+        Returns:
+            tuple: The list of lines, each including its line break, and the list of
+                   offsets or None if the offsets were not requested. The lists are
+                   empty if no complete line is available.
+        """
+        if self._orphan is not None:
+            lines, self._orphan = [self._orphan], None
+            return lines, [self.offset] if with_offsets else None
+
+        # read until a block completes a line, such that a line longer than a block
+        # does not have to wait for the next change of the file
+        partial = self._partial
+        while True:
+            length = self._file.readinto(self._buffer)
+            if not length:
+                return [], [] if with_offsets else None
+
+            start = len(partial)
+            partial += self._view[:length]
+            end = partial.rfind(b'\n', start) + 1
+            if end > 0:
+                break
+
+        block = bytes(partial[:end])
+        del partial[:end]
+        return self._split(block, with_offsets)
+
+    def read_backlog(self, end, max_lines, with_offsets=False):
+        """ Read the complete lines up to a byte offset in chunks from a memory map.
+
+        Has to be called right after the file was opened. The file is read from
+        its memory map in blocks that end at a line break. Afterwards the file
+        position is set behind the last complete line, such that read_lines()
+        continues exactly where the backlog stopped.
+
+        Args:
+            end (int): The byte offset up to which the lines are read, usually the
+                       size of the file when it was opened.
+            max_lines (int): The maximum number of lines of a chunk.
+            with_offsets (bool): Also return the byte offset behind each line.
+
+        Yields:
+            tuple: The list of lines of a chunk and the list of their offsets or None
+                   if the offsets were not requested.
+        """
+        if end <= self.offset:
+            return
+
+        max_lines = max(max_lines, 1)
+        lines = []
+        offsets = []
+        try:
+            with mmap.mmap(self._file.fileno(), end, access=mmap.ACCESS_READ) as mapped:
+                while self.offset < end:
+                    stop = mapped.rfind(b'\n', self.offset,
+                                        min(self.offset + len(self._buffer), end)) + 1
+                    if stop == 0:
+                        # the line is longer than a block
+                        stop = mapped.find(b'\n', self.offset, end) + 1
+                        if stop == 0:
+                            break
+
+                    new_lines, new_offsets = self._split(mapped[self.offset:stop],
+                                                         with_offsets)
+                    lines.extend(new_lines)
+                    if with_offsets:
+                        offsets.extend(new_offsets)
+
+                    full = len(lines) - len(lines) % max_lines
+                    for start in range(0, full, max_lines):
+                        yield (lines[start:start + max_lines],
+                               offsets[start:start + max_lines] if with_offsets
+                               else None)
+                    del lines[0:full]
+                    del offsets[0:full]
+
+            if lines:
+                yield lines, offsets if with_offsets else None
+        finally:
+            self._file.seek(self.offset)
+
+    def check_rotation(self):
+        """ Detect a truncated or replaced file and continue with its new content.
+
+        Has to be called after read_lines() returned no lines, such that the old file
+        has been read completely.
+
+        Returns:
+            bool: True if the file was truncated or replaced.
+        """
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            # the file has been moved away and not yet been replaced
+            return False
+
+        if (stat.st_dev, stat.st_ino) != self._identity:
+            logger.info('The file {} has been replaced, reading the new '
+                        'file'.format(self._path))
+            orphan = self._decoder.decode(bytes(self._partial), final=True)
+            self._file.close()
+            self.open(offset=0)
+            if orphan:
+                self._orphan = orphan
+            return True
+
+        if self.size < self.offset + len(self._partial):
+            logger.info('The file {} has been truncated, reading it from '
+                        'the beginning'.format(self._path))
+            self._file.seek(0)
+            self._reset(0)
+            return True
+        return False
+
+    def checkpoint(self, offset=None):
+        """ Return the state from which reading can be resumed.
+
+        Args:
+            offset (int, None): The offset that is stored. Defaults to the offset
+                                behind the last complete line.
+
+        Returns:
+            dict: The device, inode and offset of the file.
+        """
+        return {'identity': list(self._identity),
+                'offset': self.offset if offset is None else offset}
+
+    def close(self):
+        """ Close the file. """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _split(self, block, with_offsets):
+        """ Decode a block of complete lines that starts at the current offset. """
+        offsets = None
+        if with_offsets:
+            sizes = map((1).__add__, map(len, block.split(b'\n')[:-1]))
+            offsets = list(accumulate(chain((self.offset,), sizes)))[1:]
+        self.offset += len(block)
+
+        lines = self._decoder.decode(block).split('\n')
+        lines.pop()
+        return [line + '\n' for line in lines], offsets
+
+    def _reset(self, offset):
+        """ Forget the carried over data and the decoder state. """
+        self.offset = offset
+        self._partial.clear()
+        self._decoder.reset()
+
+
+def load_checkpoint(path):
+    """ Load the state of a line reader from a checkpoint file.
+
+    Args:
+        path (str): The path to the checkpoint file.
+
+    Returns:
+        dict: The state as returned by LineReader.checkpoint() or None if the
+              checkpoint file does not exist or cannot be read.
+    """
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(path, state):
+    """ Atomically write the state of a line reader to a checkpoint file.
+
+    Args:
+        path (str): The path to the checkpoint file.
+        state (dict): The state as returned by LineReader.checkpoint().
+    """
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(temp_path, path)
@@ -1,14 +1,34 @@
 import os
 import time
+import fnmatch
+import inotify.constants as constants
 
 from lightflow.queue import JobType
 from lightflow.logger import get_logger
 from lightflow.models import BaseTask, TaskParameters, Action
-from .exceptions import LightflowFilesystemPathError
+from .exceptions import LightflowFilesystemConfigError, LightflowFilesystemPathError
+from .inotify_watcher import InotifyWatcher
+from .line_batcher import LineBatcher
+from .line_filter import LineFilter, PARSERS
+from .line_reader import LineReader, load_checkpoint, save_checkpoint
+from .trigger_metrics import TriggerMetrics
 
 
 logger = get_logger(__name__)
 
+# the maximum time in seconds the inotify backend waits for the file to change before
+# checking the stop signal
+STOP_CHECK_INTERVAL = 2.0
+
+# the minimum time in seconds between two writes of the checkpoint file
+CHECKPOINT_INTERVAL = 1.0
+
+# the minimum time in seconds between two scans for new files by the poll backend
+DISCOVER_INTERVAL = 2.0
+
+# the characters that turn a file name into a glob
+GLOB_CHARACTERS = frozenset('*?[')
+
 
 class NewLineTriggerTask(BaseTask):
     """ Triggers a callback function upon a new line added to a file.
@@ -16,10 +36,23 @@ class NewLineTriggerTask(BaseTask):
     This trigger task watches a specified file for new line. After having
     aggregated a given number of line changes it calls the provided callback function with
     a list of lines that were added.
+
+    Several files can be watched at once by giving a list of paths or a glob, in
+    which case files that are created later and match the glob are watched as well.
+    All files are serviced by a single loop.
+
+    Lines can be filtered by regular expressions and parsed into records before
+    they are aggregated, such that only the lines of interest are handed to the
+    callback.
     """
     def __init__(self, name, path, callback,
                  aggregate=None, use_existing=False, flush_existing=True,
-                 event_trigger_time=0.5, stop_polling_rate=2, *,
+                 event_trigger_time=0.5, stop_polling_rate=2,
+                 metrics_interval=None, metrics_key=None, backend='poll',
+                 checkpoint=None, encoding='utf-8', errors='strict',
+                 block_size=1048576, aggregate_per_file=False,
+                 include=None, exclude=None, parse=None, fields=None, delimiter=',',
+                 stream_existing=False, *,
                  callback_init=None, callback_finally=None,
                  queue=JobType.Task, force_run=False, propagate_skip=True):
         """ Initialize the filesystem notify trigger task.
@@ -29,24 +62,94 @@ class NewLineTriggerTask(BaseTask):
 
         Args:
             name (str): The name of the task.
-            path: The path to the file that should be watched for new lines.
-                  The path has to be an absolute path, otherwise an exception is thrown.
+            path: The path to the file that should be watched for new lines, or a
+                  list of paths. The file name of a path may be a glob, such as
+                  '/data/logs/*.log', in order to watch all matching files, including
+                  files that are created while the task is running. Files that are
+                  created later are read from their beginning. The paths have to be
+                  absolute paths, otherwise an exception is thrown.
             callback (callable): A callable object that is called with the list of lines
-                                 that have changed. The function definition is
+                                 that have changed. The list is a LineBatch, whose
+                                 'path' attribute is the file the lines were read
+                                 from, or None if they were read from several files,
+                                 and whose 'sources' attribute lists the file each
+                                 line was read from.
+                                 The function definition is
                                  def callback(lines, data, store, signal, context).
             aggregate (int, None): The number of lines that are aggregated before the
                                    callback is called. Set to None or 1 to trigger
                                    on each new line event occurrence.
             use_existing (bool): Use the existing lines that are located in file for
-                                 initialising the line list.
+                                 initialising the line list. Ignored if reading is
+                                 resumed from a checkpoint.
             flush_existing (bool): If 'use_existing' is True, then flush all existing
                                    lines without regard to the aggregation setting.
                                    I.e,. all existing lines are sent to the callback.
             event_trigger_time (float, None): The waiting time between events in seconds.
-                                              Set to None to turn off.
+                                              Set to None to turn off. Only used by
+                                              the 'poll' backend.
             stop_polling_rate (float): The number of events after which a signal is sent
                                        to the workflow to check whether the task
                                        should be stopped.
+            metrics_interval (float, None): The time in seconds between two reports of
+                                            the throughput and latency figures, which
+                                            are written as a log line. Set to None to
+                                            turn off.
+            metrics_key (str, None): The key of the data store under which the
+                                     figures are stored on each report. Set to None
+                                     to only log the figures.
+            backend (str): The mechanism that detects new lines. Either 'poll' for
+                           reading the file again after waiting 'event_trigger_time'
+                           seconds, or 'inotify' for blocking until the kernel
+                           reports a change of the file. Keep 'poll' for network
+                           filesystems, where inotify does not report the changes
+                           made by other clients.
+            checkpoint (str, None): The path to a file in which the byte offset behind
+                                    the last line that was handed to the callback is
+                                    stored for each watched file, together with the
+                                    device and inode of the file. A restarted task
+                                    resumes reading at this offset, unless the file has
+                                    been replaced or truncated in the meantime. The
+                                    file is written at most once per second and
+                                    when the task stops, such that lines may be
+                                    handed over twice after a crash. Set to None
+                                    to turn off.
+            encoding (str): The encoding of the file. Lines are split at the byte
+                            b'\\n', thus the encoding has to be ASCII compatible.
+            errors (str): The handling of bytes that cannot be decoded, for example
+                          'strict' for raising an exception, 'replace' or 'ignore'.
+            block_size (int): The maximum number of bytes that are read from the
+                              file at once. All complete lines of a block are
+                              split and decoded in one go.
+            aggregate_per_file (bool): Aggregate the lines of each file separately,
+                                       such that each list of lines that is sent to
+                                       the callback belongs to a single file.
+            include (str, list, None): A regular expression or a list of regular
+                                       expressions of which a line has to match at
+                                       least one in order to be handed to the
+                                       callback. Set to None to include all lines.
+            exclude (str, list, None): A regular expression or a list of regular
+                                       expressions of which a line must not match
+                                       any in order to be handed to the callback.
+                                       Set to None to exclude no lines.
+            parse (str, None): Parse the included lines into records, which are
+                               handed to the callback instead of the lines. Either
+                               'json' for JSON lines, 'csv' for comma separated
+                               values or 'kv' for key=value pairs. Lines that cannot
+                               be parsed are dropped. Set to None to hand over the
+                               lines.
+            fields (list, None): The names of the csv columns. If given, each csv
+                                 record is a dictionary, otherwise a list.
+            delimiter (str): The delimiter of the csv columns.
+            stream_existing (bool): If 'use_existing' is True, scan the existing
+                                    content of the file from a memory map and hand
+                                    it to the callback in chunks of 'aggregate'
+                                    lines while it is scanned, instead of reading
+                                    all existing lines into memory first. With
+                                    'flush_existing' the lines of the last partial
+                                    chunk are handed over as well, otherwise they
+                                    are aggregated with the new lines. Tailing
+                                    continues right behind the last existing line.
             queue (str): Name of the queue the task should be scheduled to. Defaults to
                          the general task queue.
             callback_init (callable): A callable that is called shortly before the task
@@ -83,6 +186,20 @@ class NewLineTriggerTask(BaseTask):
             flush_existing=flush_existing,
             event_trigger_time=event_trigger_time,
             stop_polling_rate=stop_polling_rate,
+            metrics_interval=metrics_interval,
+            metrics_key=metrics_key,
+            backend=backend,
+            checkpoint=checkpoint,
+            encoding=encoding,
+            errors=errors,
+            block_size=block_size,
+            aggregate_per_file=aggregate_per_file,
+            include=include,
+            exclude=exclude,
+            parse=parse,
+            fields=fields,
+            delimiter=delimiter,
+            stream_existing=stream_existing
         )
         self._callback = callback
 
@@ -100,69 +217,281 @@ class NewLineTriggerTask(BaseTask):
             context (TaskContext): The context in which the tasks runs.
 
         Raises:
-            LightflowFilesystemPathError: If the specified path is not absolute.
+            LightflowFilesystemPathError: If a specified path is not absolute or its
+                                          directory contains a glob.
+            LightflowFilesystemConfigError: If the backend or the parse format is not
+                                            known.
         """
         params = self.params.eval(data, store)
+        patterns = self._patterns(params.path)
 
-        if not os.path.isabs(params.path):
-            raise LightflowFilesystemPathError(
-                'The specified path is not an absolute path')
+        if params.backend not in ('inotify', 'poll'):
+            raise LightflowFilesystemConfigError(
+                'The backend has to be either inotify or poll')
 
-        # if requested, pre-fill the file list with existing lines
-        lines = []
-        num_read_lines = 0
-        if params.use_existing:
-            with open(params.path, 'r') as file:
-                lines = file.readlines()
+        if params.parse is not None and params.parse not in PARSERS:
+            raise LightflowFilesystemConfigError(
+                'The parse format has to be one of {}'.format(', '.join(PARSERS)))
 
-            num_read_lines = len(lines)
-            if params.flush_existing and num_read_lines > 0:
-                if self._callback is not None:
-                    self._callback(lines, data, store, signal, context)
+        state = load_checkpoint(params.checkpoint) \
+            if params.checkpoint is not None else None
+        state = state or {}
 
-                del lines[:]
+        # the readers of the watched files and the byte offset behind the last line
+        # of each file that was handed to the callback, which is stored in the
+        # checkpoint
+        readers = {}
+        committed = {}
+        track_offsets = params.checkpoint is not None
+        last_checkpoint = time.monotonic()
+        batcher = LineBatcher(params.aggregate, per_file=params.aggregate_per_file,
+                              track_offsets=track_offsets)
+        line_filter = LineFilter(include=params.include, exclude=params.exclude,
+                                 parse=params.parse, fields=params.fields,
+                                 delimiter=params.delimiter)
 
         polling_event_number = 0
 
-        def watch_file(file_pointer, task_signal):
-            while True:
-                if task_signal.is_stopped:
-                    break
+        if params.metrics_interval is not None:
+            metrics = TriggerMetrics(self.name, params.metrics_interval,
+                                     store=store, store_key=params.metrics_key)
+        else:
+            metrics = None
+        first_line_time = time.monotonic()
+
+        # the files that existed at the start and the size up to which their existing
+        # lines are read
+        existing = []
+
+        def add(path, lines, offsets):
+            # filter and parse the lines before they are aggregated
+            count = len(lines)
+            if line_filter.is_active:
+                lines, offsets = line_filter.apply(lines, offsets)
+            if metrics is not None:
+                metrics.add_events(count, len(lines))
+            if lines:
+                batcher.add(path, lines, offsets)
+
+        def write_checkpoint():
+            save_checkpoint(params.checkpoint,
+                            {path: readers[path].checkpoint(offset)
+                             for path, offset in committed.items()})
 
-                new = file_pointer.readline()
-                if new:
-                    yield new
+        def call_back(batches):
+            nonlocal last_checkpoint
+            for batch in batches:
+                if self._callback is not None:
+                    started = time.monotonic()
+                    self._callback(batch, data, store, signal, context)
+                    if metrics is not None:
+                        metrics.add_callback(started - first_line_time,
+                                             time.monotonic() - started)
+
+                if track_offsets:
+                    committed.update(batch.offsets)
+                    if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                        write_checkpoint()
+                        last_checkpoint = time.monotonic()
+
+        def report():
+            if metrics is not None:
+                metrics.report(pending_lines=len(batcher), files=len(readers))
+
+        def discover(initial=False):
+            # open a reader for each matching file that is not read yet. Files that
+            # exist at the start are read according to the checkpoint or the
+            # use_existing option, files that appear later from their beginning.
+            for directory, pattern, is_glob in patterns:
+                if is_glob:
+                    try:
+                        names = fnmatch.filter(os.listdir(directory), pattern)
+                    except OSError:
+                        continue
                 else:
-                    time.sleep(params.event_trigger_time)
+                    names = [pattern]
+
+                for name in names:
+                    path = os.path.join(directory, name)
+                    if path in readers or not os.path.isfile(path):
+                        continue
+
+                    reader = LineReader(path, encoding=params.encoding,
+                                        errors=params.errors,
+                                        block_size=params.block_size)
+                    file_state = state.pop(path, None)
+                    try:
+                        if file_state is not None:
+                            reader.open(offset=file_state['offset'],
+                                        identity=file_state['identity'])
+                        elif initial:
+                            reader.open(offset=0 if params.use_existing else None)
+                        else:
+                            reader.open(offset=0)
+                    except OSError as e:
+                        logger.warning('Could not open {}: {}'.format(path, e))
+                        continue
+
+                    readers[path] = reader
+                    committed[path] = reader.offset
+
+                    if initial and params.use_existing and file_state is None:
+                        existing.append((path, reader.size))
+
+        def read_existing(path, end):
+            # read the lines that existed at the start and return False if the task
+            # was stopped in the meantime
+            nonlocal polling_event_number
+            reader = readers[path]
+            if not params.stream_existing:
+                while reader.offset < end:
+                    new_lines, new_offsets = reader.read_lines(track_offsets)
+                    if not new_lines:
+                        break
+                    add(path, new_lines, new_offsets)
+                return True
+
+            for new_lines, new_offsets in reader.read_backlog(end, params.aggregate,
+                                                              track_offsets):
+                add(path, new_lines, new_offsets)
+                call_back(batcher.pop_ready())
+                report()
+
+                polling_event_number += len(new_lines)
+                if polling_event_number > params.stop_polling_rate:
+                    polling_event_number = 0
+                    if signal.is_stopped:
+                        return False
+            return True
+
+        # the inotify backend watches the directories of the files, such that it is
+        # notified about changes, new files and the replacement of files without
+        # sleeping
+        if params.backend == 'inotify':
+            watcher = InotifyWatcher()
+            watched = {}
+            for directory, pattern, _ in patterns:
+                watched.setdefault(os.fsencode(directory), []).append(pattern)
+            for directory in watched:
+                watcher.add_watch(directory,
+                                  constants.IN_MODIFY | constants.IN_CLOSE_WRITE |
+                                  constants.IN_CREATE | constants.IN_MOVED_TO)
+        else:
+            watcher = None
+        next_discover = time.monotonic() + DISCOVER_INTERVAL
+
+        def wait_for_change():
+            # wait for a change and return whether new files have to be looked for
+            nonlocal next_discover
+            if watcher is None:
+                time.sleep(params.event_trigger_time)
+                if time.monotonic() < next_discover:
+                    return False
+                next_discover = time.monotonic() + DISCOVER_INTERVAL
+                return True
+
+            deadline = time.monotonic() + STOP_CHECK_INTERVAL
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0.0:
+                    return False
+                changed = False
+                for mask, _, watch_path, name, _ in watcher.read_events(timeout):
+                    if mask & constants.IN_Q_OVERFLOW:
+                        # events were lost, so the files are read again and new
+                        # files are looked for
+                        return True
+                    if watch_path is None:
+                        continue
+                    path = os.fsdecode(os.path.join(watch_path, name))
+                    if path in readers:
+                        changed = True
+                    elif any(fnmatch.fnmatch(os.fsdecode(name), pattern)
+                             for pattern in watched.get(watch_path, ())):
+                        return True
+                if changed:
+                    return False
 
-        file = open(params.path, 'r')
         try:
-            if params.use_existing:
-                for i in range(num_read_lines):
-                    file.readline()
-            else:
-                file.seek(0, 2)
+            discover(initial=True)
+            stopped = not all(read_existing(path, end) for path, end in existing)
+            if params.use_existing and params.flush_existing and not stopped:
+                call_back(batcher.pop_all())
 
-            for line in watch_file(file, signal):
-                lines.append(line)
+            while not stopped:
+                count = 0
+                for path, reader in readers.items():
+                    new_lines, new_offsets = reader.read_lines(track_offsets)
+                    if new_lines:
+                        if metrics is not None and count == 0 and not len(batcher):
+                            first_line_time = time.monotonic()
+                        add(path, new_lines, new_offsets)
+                        count += len(new_lines)
+
+                if count == 0:
+                    # the pending lines of a replaced file cannot be resumed
+                    rotated = False
+                    for path, reader in readers.items():
+                        if reader.check_rotation():
+                            batcher.reset_offsets(path)
+                            committed[path] = 0
+                            rotated = True
+                    if rotated:
+                        continue
+
+                    report()
+                    if signal.is_stopped:
+                        break
+                    if wait_for_change():
+                        discover()
+                    continue
 
                 # check every stop_polling_rate events the stop signal
-                polling_event_number += 1
+                polling_event_number += count
                 if polling_event_number > params.stop_polling_rate:
                     polling_event_number = 0
                     if signal.is_stopped:
                         break
 
                 # as soon as enough lines have been aggregated call the callback function
-                if len(lines) >= params.aggregate:
-                    chunks = len(lines) // params.aggregate
-                    for i in range(0, chunks):
-                        if self._callback is not None:
-                            self._callback(lines[0:params.aggregate], data,
-                                           store, signal, context)
-
-                        del lines[0:params.aggregate]
+                batches = batcher.pop_ready()
+                if batches:
+                    call_back(batches)
+                    report()
         finally:
-            file.close()
+            if track_offsets:
+                write_checkpoint()
+            for reader in readers.values():
+                reader.close()
+            if watcher is not None:
+                watcher.close()
 
         return Action(data)
+
+    @staticmethod
+    def _patterns(path):
+        """ Split the paths of the watched files into their directory and file name.
+
+        Args:
+            path (str, list): The path or the list of paths of the watched files.
+
+        Returns:
+            list: A tuple of the directory, the file name pattern and whether the
+                  pattern is a glob for each path.
+
+        Raises:
+            LightflowFilesystemPathError: If a path is not absolute or its directory
+                                          contains a glob.
+        """
+        patterns = []
+        for file_path in [path] if isinstance(path, str) else path:
+            if not os.path.isabs(file_path):
+                raise LightflowFilesystemPathError(
+                    'The specified path is not an absolute path')
+
+            directory, name = os.path.split(file_path)
+            if GLOB_CHARACTERS.intersection(directory):
+                raise LightflowFilesystemPathError(
+                    'Only the file name of a path can be a glob')
+            patterns.append((directory, name, bool(GLOB_CHARACTERS.intersection(name))))
+        return patterns
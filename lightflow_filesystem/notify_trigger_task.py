@@ -1,45 +1,92 @@
 import os
 import re
 import time
-import inotify.adapters as adapters
 import inotify.constants as constants
 
 from lightflow.queue import JobType
 from lightflow.logger import get_logger
 from lightflow.models import BaseTask, TaskParameters, Action
-from .exceptions import LightflowFilesystemPathError
+from .exceptions import LightflowFilesystemConfigError, LightflowFilesystemPathError
+from .duplicate_filter import DuplicateFilter
+from .batch_dispatcher import BatchDispatcher, POLICIES
+from .dag_limiter import DagLimiter
+from .file_batcher import FileBatcher, FileBatch
+from .debouncer import Debouncer
+from .file_journal import FileJournal
+from .file_matcher import FileMatcher
+from .trigger_metrics import TriggerMetrics
+from .inotify_watcher import (InotifyWatcher, REGISTER_INITIAL, REGISTER_MOVED,
+                              REGISTER_RESCAN, max_queued_events)
 
 
 logger = get_logger(__name__)
 
+# the number of directories that are registered in between reading events
+REGISTER_CHUNK_SIZE = 100
+
+# the time in seconds between two log messages about the watch registration progress
+PROGRESS_INTERVAL = 10.0
+
+# the time in seconds before the last complete read of the event queue from which on
+# files are considered by the rescan after an overflow of the queue
+RECONCILE_SLACK = 2.0
+
+# the time in seconds between two checks for a free dag slot while at the dag limit
+ADMISSION_POLL_INTERVAL = 0.5
+
+# the options that can be set for each root directory individually
+ROOT_OPTIONS = ('recursive', 'on_file_create', 'on_file_close', 'on_file_delete',
+                'on_file_move')
+
 
 class NotifyTriggerTask(BaseTask):
-    """ Triggers a callback function upon file changes in a directory.
+    """ Triggers a callback function upon file changes in one or more directories.
 
-    This trigger task watches a specified directory for file changes. After having
+    This trigger task watches the specified directories for file changes. After having
     aggregated a given number of file changes it calls the provided callback function
-    with a list of the files that were changed.
+    with a list of the files that were changed. All directories are watched by a
+    single inotify instance from a single event loop.
     """
     def __init__(self, name, path, callback,
                  recursive=True, aggregate=None, skip_duplicate=False,
                  use_existing=False, flush_existing=True, exclude_mask=None,
                  on_file_create=False, on_file_close=True,
                  on_file_delete=False, on_file_move=False,
-                 event_trigger_time=None, stop_polling_rate=2, *,
+                 event_trigger_time=None, stop_polling_rate=None,
+                 duplicate_window=None, duplicate_timeout=None,
+                 max_wait=None, max_batch_bytes=None,
+                 max_watches=None, poll_interval=5.0, backend='inotify',
+                 journal=None, aggregate_per_root=False,
+                 include=None, exclude=None, exclude_dirs=None,
+                 max_pending_batches=100, backpressure='block', spill_dir=None,
+                 metrics_interval=None, metrics_key=None,
+                 group_by=None, group_idle_time=None, group_complete=None,
+                 max_running_dags=None, max_batch_files=None, dag_stats_key=None,
+                 stop_check_interval=2.0, *,
                  callback_init=None, callback_finally=None,
                  queue=JobType.Task, force_run=False, propagate_skip=True):
         """ Initialize the filesystem notify trigger task.
 
-        All task parameters except the name, callback, queue, force_run and propagate_skip
-        can either be their native type or a callable returning the native type.
+        All task parameters except the name, callback, group_by, queue, force_run and
+        propagate_skip can either be their native type or a callable returning the
+        native type.
 
         Args:
             name (str): The name of the task.
             path: The path to the directory that should be watched for filesystem changes.
                   The path has to be an absolute path, otherwise an exception is thrown.
+                  Multiple directories are watched by passing a list of paths. Each
+                  entry of the list can also be a dictionary with the key 'path' and
+                  any of the keys 'recursive', 'on_file_create', 'on_file_close',
+                  'on_file_delete' and 'on_file_move', which override the task wide
+                  settings for this directory.
             callback (callable): A callable object that is called with the list of files
                                  that have changed. The function definition is
                                  def callback(files, data, store, signal, context).
+                                 The list is a FileBatch, whose attribute 'root' holds
+                                 the watched directory the files belong to, or None if
+                                 the files belong to different directories. Its
+                                 attribute 'group' holds the group key of the files.
             recursive (bool): Set to True to watch for file system changes in
                               subdirectories of the specified path. Keeps track of
                               the creation and deletion of subdirectories.
@@ -53,22 +100,152 @@ class NotifyTriggerTask(BaseTask):
                                    an existing file is modified before the aggregated
                                    files are sent to the callback function.
             use_existing (bool): Use the existing files that are located in path for
-                                 initializing the file list.
-            flush_existing (bool): If 'use_existing' is True, then flush all existing
-                                   files without regard to the aggregation setting.
-                                   I.e,. all existing files sent to the callback.
+                                 initializing the file list. The existing files are
+                                 listed directory by directory while the watches are
+                                 registered and the events of new files are already
+                                 being processed.
+            flush_existing (bool): If 'use_existing' is True, then send the existing
+                                   files to the callback in lists of 'aggregate' files
+                                   as they are scanned, including a final partial
+                                   list, without mixing them with new files.
             exclude_mask (str): Specifies a regular expression that can be used to exclude
                                 files. For example if a detector creates temporary files
                                 that should not be sent to the callback function.
+                                The expression is searched for in the full path of
+                                each file. Prefer 'exclude' for patterns that only
+                                depend on the file name.
             on_file_create (bool): Set to True to listen for file creation events.
             on_file_close (bool): Set to True to listen for file closing events.
             on_file_delete (bool): Set to True to listen for file deletion events.
             on_file_move (bool):  Set to True to listen for file move events.
-            event_trigger_time (float, None): The waiting time between events in seconds.
+            event_trigger_time (float, None): The settle time of a file in seconds. A
+                                              file is only added to the list of files
+                                              after no further events for this file
+                                              occurred within the settle time.
                                               Set to None to turn off.
-            stop_polling_rate (float): The number of events after which a signal is sent
-                                       to the workflow to check whether the task
-                                       should be stopped.
+            stop_polling_rate (int, None): The number of events after which a signal
+                                           is sent to the workflow to check whether
+                                           the task should be stopped. Set to None
+                                           to only check every
+                                           'stop_check_interval' seconds.
+            duplicate_window (int, None): The number of most recently seen file names
+                                          that are remembered for skipping duplicates.
+                                          Set to None for no limit.
+            duplicate_timeout (float, None): The time in seconds a file name is
+                                             remembered for skipping duplicates.
+                                             Set to None for no limit. If neither the
+                                             window nor the timeout are set, only
+                                             duplicates within the list of files that
+                                             have not yet been sent to the callback
+                                             are skipped.
+            max_wait (float, None): The maximum time in seconds a file waits in a
+                                    partially aggregated list before the list is sent
+                                    to the callback function. Set to None to only
+                                    flush full lists.
+            max_batch_bytes (int, None): Send the aggregated files to the callback
+                                         function as soon as their cumulative size
+                                         reaches this number of bytes. Set to None
+                                         to turn off.
+            max_watches (int, None): The maximum number of inotify watches the task
+                                     uses. Directories beyond this budget, or beyond
+                                     the kernel limit, are polled instead of watched.
+                                     Set to None to only be limited by the kernel.
+            poll_interval (float): The time in seconds between two polls of the
+                                   directories that are not watched.
+            backend (str): The mechanism that detects file changes. Either 'inotify'
+                           for kernel notifications or 'poll' for comparing periodic
+                           snapshots of the directories. Use 'poll' for network
+                           filesystems, where inotify does not report the changes
+                           made by other clients. When polling, a file is reported as
+                           closed once its size and modification time did not change
+                           between two polls.
+            journal (str, None): The path to a database file in which the files that
+                                 were sent to the callback are recorded, together
+                                 with their size and modification time. Existing
+                                 files that are found in the journal unchanged are
+                                 skipped, such that a restarted task with
+                                 'use_existing' only sends the files that arrived
+                                 while it was not running. Set to None to turn off.
+            aggregate_per_root (bool): Aggregate the files of each watched directory
+                                       separately, such that each list of files that
+                                       is sent to the callback belongs to a single
+                                       directory.
+            include (str, list, None): A pattern or a list of patterns of which the name
+                                       of a file has to match at least one. Patterns
+                                       are globs, such as '*.h5', or regular
+                                       expressions prefixed by 're:'. The patterns are
+                                       matched against the file name only, before the
+                                       name is decoded. Set to None to include all
+                                       files.
+            exclude (str, list, None): A pattern or a list of patterns of which the name
+                                       of a file must not match any. Set to None to
+                                       exclude no files.
+            exclude_dirs (str, list, None): A pattern or a list of patterns for the
+                                            names of subdirectories that are not
+                                            watched, including their whole subtree.
+                                            Set to None to watch all subdirectories.
+            max_pending_batches (int): The maximum number of lists of files that wait
+                                       for the callback. The callback is called from
+                                       a separate thread, such that the events are
+                                       read while the callback is running.
+            backpressure (str): The handling of a list of files while the maximum
+                                number of lists is waiting for the callback. Either
+                                'block' for pausing the reading of events, 'coalesce'
+                                for appending the files to the last waiting list of
+                                the same root and group, which blocks if there is
+                                none or the list would exceed 'max_batch_files', or
+                                'spill' for writing the list to a temporary file.
+            spill_dir (str, None): The directory of the temporary file for the
+                                   'spill' policy. Defaults to the system's temporary
+                                   directory.
+            metrics_interval (float, None): The time in seconds between two reports of
+                                            the throughput and latency figures, which
+                                            are written as a log line. Set to None to
+                                            turn off.
+            metrics_key (str, None): The key of the data store under which the
+                                     figures are stored on each report. Set to None
+                                     to only log the figures.
+            group_by (str, callable, None): Aggregate the files of each group separately,
+                                            such that a list of files sent to the
+                                            callback never mixes groups. Either
+                                            'parent' for grouping by the parent
+                                            directory, a regular expression whose
+                                            first capture group, or whole match, in
+                                            the file path is the group key, or a
+                                            callable that is called with the file
+                                            path and returns the group key. Files
+                                            without a key form a common group.
+                                            Set to None to turn off.
+            group_idle_time (float, None): The time in seconds without a new file
+                                           after which the files of a group are sent
+                                           to the callback. Set to None to turn off.
+            group_complete (str, list, None): A pattern or a list of patterns for the
+                                              name of a file that marks a group as
+                                              complete. The files of the group,
+                                              including the marker, are sent to the
+                                              callback as soon as the marker arrives.
+                                              Patterns are written as for 'include'.
+                                              Set to None to turn off.
+            max_running_dags (int, None): The maximum number of dags started by the
+                                          callback that may run at the same time.
+                                          The callback is handed a signal object
+                                          that keeps track of the dags it starts.
+                                          While at the limit, no lists of files are
+                                          sent to the callback and the pending lists
+                                          keep growing. Existing files are then
+                                          aggregated like new files. Set to None
+                                          for no limit.
+            max_batch_files (int, None): The maximum number of files in a list that
+                                         grew beyond 'aggregate' while at the dag
+                                         limit or by coalescing. Set to None for no
+                                         limit.
+            dag_stats_key (str, None): The key of the data store under which the
+                                       number of started, finished and running dags
+                                       is stored. Set to None to turn off.
+            stop_check_interval (float): The time in seconds after which a signal is
+                                         sent to the workflow to check whether the
+                                         task should be stopped, regardless of the
+                                         number of events.
             queue (str): Name of the queue the task should be scheduled to. Defaults to
                          the general task queue.
             callback_init (callable): A callable that is called shortly before the task
@@ -103,17 +280,42 @@ class NotifyTriggerTask(BaseTask):
             recursive=recursive,
             aggregate=aggregate if aggregate is not None else 1,
             skip_duplicate=skip_duplicate,
+            duplicate_window=duplicate_window,
+            duplicate_timeout=duplicate_timeout,
             use_existing=use_existing,
             flush_existing=flush_existing,
             exclude_mask=exclude_mask,
             event_trigger_time=event_trigger_time,
             stop_polling_rate=stop_polling_rate,
+            stop_check_interval=stop_check_interval,
+            max_wait=max_wait,
+            max_batch_bytes=max_batch_bytes,
+            max_watches=max_watches,
+            poll_interval=poll_interval,
+            backend=backend,
+            journal=journal,
+            aggregate_per_root=aggregate_per_root,
+            include=include,
+            exclude=exclude,
+            exclude_dirs=exclude_dirs,
+            max_pending_batches=max_pending_batches,
+            backpressure=backpressure,
+            spill_dir=spill_dir,
+            metrics_interval=metrics_interval,
+            metrics_key=metrics_key,
+            group_by=None if callable(group_by) else group_by,
+            group_idle_time=group_idle_time,
+            group_complete=group_complete,
+            max_running_dags=max_running_dags,
+            max_batch_files=max_batch_files,
+            dag_stats_key=dag_stats_key,
             on_file_create=on_file_create,
             on_file_close=on_file_close,
             on_file_delete=on_file_delete,
             on_file_move=on_file_move
         )
         self._callback = callback
+        self._group_by = group_by if callable(group_by) else None
 
     def run(self, data, store, signal, context, **kwargs):
         """ The main run method of the NotifyTriggerTask task.
@@ -129,26 +331,34 @@ class NotifyTriggerTask(BaseTask):
             context (TaskContext): The context in which the tasks runs.
 
         Raises:
-            LightflowFilesystemPathError: If the specified path is not absolute.
+            LightflowFilesystemPathError: If a specified path is not absolute.
+            LightflowFilesystemConfigError: If the backend, the backpressure policy or
+                                            a path option is not known.
         """
         params = self.params.eval(data, store)
 
-        # build notification mask
-        on_file_create = constants.IN_CREATE if params.on_file_create else 0x00000000
-        on_file_close = constants.IN_CLOSE_WRITE if params.on_file_close else 0x00000000
-        on_file_delete = constants.IN_DELETE if params.on_file_delete else 0x00000000
-        on_file_move = constants.IN_MOVE if params.on_file_move else 0x00000000
-        mask = (on_file_create | on_file_close | on_file_delete | on_file_move)
+        if params.backend not in ('inotify', 'poll'):
+            raise LightflowFilesystemConfigError(
+                'The backend has to be either inotify or poll')
 
-        if not os.path.isabs(params.path):
-            raise LightflowFilesystemPathError(
-                'The specified path is not an absolute path')
+        if params.backpressure not in POLICIES:
+            raise LightflowFilesystemConfigError(
+                'The backpressure has to be one of {}'.format(', '.join(POLICIES)))
 
-        if params.recursive:
-            notify = adapters.InotifyTree(params.path.encode('utf-8'))
-        else:
-            notify = adapters.Inotify()
-            notify.add_watch(params.path.encode('utf-8'))
+        # build the notification mask of each root directory
+        roots = self._roots(params)
+        masks = {}
+        for root in roots:
+            masks[root['path']] = \
+                (constants.IN_CREATE if root['on_file_create'] else 0x00000000) | \
+                (constants.IN_CLOSE_WRITE if root['on_file_close'] else 0x00000000) | \
+                (constants.IN_DELETE if root['on_file_delete'] else 0x00000000) | \
+                (constants.IN_MOVE if root['on_file_move'] else 0x00000000)
+
+        # a pending file has to be notified about further changes to its content
+        extra_mask = constants.IN_DELETE_SELF
+        if params.event_trigger_time is not None:
+            extra_mask |= constants.IN_MODIFY
 
         # setup regex
         if isinstance(params.exclude_mask, str):
@@ -156,64 +366,393 @@ class NotifyTriggerTask(BaseTask):
         else:
             regex = None
 
-        # if requested, pre-fill the file list with existing files
-        files = []
-        if params.use_existing:
-            for (dir_path, dir_names, filenames) in os.walk(params.path):
-                files.extend([os.path.join(dir_path, filename) for filename in filenames])
-                if not params.recursive:
-                    break
+        # the file name patterns are checked before the event paths are decoded
+        if params.include is not None or params.exclude is not None:
+            matcher = FileMatcher(include=params.include, exclude=params.exclude)
+        else:
+            matcher = None
+
+        if params.exclude_dirs is not None:
+            directory_filter = FileMatcher(exclude=params.exclude_dirs)
+        else:
+            directory_filter = None
+
+        # setup the index of known files for skipping duplicates. Without a window
+        # the index only covers the files that have not been sent to the callback yet
+        duplicates = DuplicateFilter(max_size=params.duplicate_window,
+                                     max_age=params.duplicate_timeout)
+        pending_only = params.duplicate_window is None and \
+            params.duplicate_timeout is None
+
+        batcher = FileBatcher(aggregate=params.aggregate,
+                              max_wait=params.max_wait,
+                              max_bytes=params.max_batch_bytes,
+                              max_idle=params.group_idle_time)
+
+        # files are aggregated separately for each root and/or group
+        group_of = self._group_by if self._group_by is not None \
+            else self._group_function(params.group_by)
+        if params.group_complete is not None:
+            markers = FileMatcher(include=params.group_complete)
+        else:
+            markers = None
+
+        # limit the number of running dags that were started by the callback
+        if params.max_running_dags is not None:
+            limiter = DagLimiter(signal, params.max_running_dags,
+                                 store=store, store_key=params.dag_stats_key)
+            callback_signal = limiter.signal
+            max_files = params.max_batch_files \
+                if params.max_batch_files is not None else float('inf')
+        else:
+            limiter = None
+            callback_signal = signal
+            max_files = None
+        completed = {}
+
+        def batch_key(new_file, root):
+            group = group_of(new_file) if group_of is not None else None
+            return group, (root if params.aggregate_per_root else None, group)
+
+        # files are held back in the debouncer until they stopped changing
+        if params.event_trigger_time is not None:
+            debouncer = Debouncer(params.event_trigger_time)
+        else:
+            debouncer = None
+
+        # the recently added files are known to the rescan after a queue overflow
+        recent = DuplicateFilter(max_age=RECONCILE_SLACK)
+        reconcile = {'since': None, 'known': set()}
+
+        def add_file(new_file, root):
+            recent.add([new_file])
+            if params.skip_duplicate and duplicates.seen(new_file):
+                return
+
+            group, key = batch_key(new_file, root)
+            batcher.add(new_file, self._file_size(new_file)
+                        if batcher.tracks_size else 0, root=root, group=group, key=key)
+
+            # a completion marker sends the files of its group right away
+            if markers is not None and \
+                    markers.matches(os.fsencode(os.path.basename(new_file))):
+                if limiter is None:
+                    flush(batcher.pop(key))
+                else:
+                    completed[key] = True
+
+        journal = None
+
+        if params.metrics_interval is not None:
+            metrics = TriggerMetrics(self.name, params.metrics_interval,
+                                     store=store, store_key=params.metrics_key)
+        else:
+            metrics = None
+
+        # the callback is called from the dispatcher thread
+        def dispatch(batch):
+            if self._callback is not None:
+                started = time.monotonic()
+                self._callback(batch, data, store, callback_signal, context)
+                if metrics is not None:
+                    metrics.add_callback(started - batch.created,
+                                         time.monotonic() - started)
+            if journal is not None:
+                journal.record(self._file_stats(batch))
+
+        dispatcher = BatchDispatcher(dispatch, max_pending=params.max_pending_batches,
+                                     policy=params.backpressure,
+                                     spill_dir=params.spill_dir,
+                                     max_files=params.max_batch_files)
+
+        def flush(batch):
+            if pending_only:
+                duplicates.discard(batch)
+            dispatcher.put(batch)
+
+        # add the files of newly registered directories that will not send an event
+        def registration_done():
+            # all directories are registered, send the last partial lists of
+            # existing files
+            reconcile['since'] = None
+            reconcile['known'].clear()
+            for batch in existing.values():
+                flush(batch)
+            existing.clear()
+            logger.info('Watching {} directories and polling {} '
+                        'directories'.format(len(watcher), watcher.polled))
+
+        def add_registered(registered):
+            for dir_path, registration_time, entries, origin, root in registered:
+                # the files of a directory renamed within the tree are known already,
+                # except for the changes of polled directories since their last poll,
+                # which are registered as created
+                if origin == REGISTER_MOVED:
+                    continue
+                use_existing = params.use_existing and origin == REGISTER_INITIAL
+                on_file_close = masks[root] & constants.IN_CLOSE_WRITE
+
+                # without existing files, only files created since the start of the
+                # task are of interest. Their creation changed the directory mtime.
+                since = None
+                known = ()
+                if origin == REGISTER_RESCAN:
+                    since = reconcile['since']
+                    known = reconcile['known']
+                elif origin == REGISTER_INITIAL and not params.use_existing:
+                    try:
+                        if os.stat(dir_path).st_mtime < start_time:
+                            continue
+                    except OSError:
+                        continue
+                    since = start_time
 
-            if regex is not None:
-                files = [file for file in files if regex.search(file) is None]
+                for entry in entries:
+                    if matcher is not None and not matcher.matches(entry.name):
+                        continue
 
-            if params.flush_existing and len(files) > 0:
-                if self._callback is not None:
-                    self._callback(files, data, store, signal, context)
-                del files[:]
+                    new_file = os.fsdecode(entry.path)
+                    if regex is not None and regex.search(new_file) is not None:
+                        continue
+                    if new_file in known or \
+                            (debouncer is not None and new_file in debouncer):
+                        continue
 
-        polling_event_number = 0
+                    if on_file_close or since is not None or journal is not None:
+                        try:
+                            stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+
+                        # files changed after the registration will send an event
+                        if on_file_close and stat.st_mtime >= registration_time:
+                            continue
+                        if since is not None and stat.st_mtime < since:
+                            continue
+                        if journal is not None and journal.contains(
+                                new_file, stat.st_size, stat.st_mtime_ns):
+                            continue
+
+                    if not use_existing or not params.flush_existing or \
+                            limiter is not None:
+                        add_file(new_file, root)
+                    elif not params.skip_duplicate or not duplicates.seen(new_file):
+                        group, key = batch_key(new_file, root)
+                        batch = existing.setdefault(
+                            key, FileBatch(root=root, group=group))
+                        batch.append(new_file)
+                        if len(batch) >= params.aggregate:
+                            flush(existing.pop(key))
+
+        # the poll backend is a watcher that polls all of its directories
+        watcher = InotifyWatcher(
+            max_watches=params.max_watches if params.backend == 'inotify' else 0,
+            poll_interval=params.poll_interval,
+            directory_filter=directory_filter)
         try:
-            for event in notify.event_gen():
-                if params.event_trigger_time is not None:
-                    time.sleep(params.event_trigger_time)
+            if params.journal is not None:
+                journal = FileJournal(params.journal)
+            dispatcher.start()
 
-                # check every stop_polling_rate events the stop signal
-                polling_event_number += 1
-                if polling_event_number > params.stop_polling_rate:
-                    polling_event_number = 0
-                    if signal.is_stopped:
-                        break
+            start_time = time.time()
+            existing = {}
+            for root in roots:
+                add_registered(watcher.add_watch(
+                    root['path'].encode('utf-8'), masks[root['path']] | extra_mask,
+                    recursive=root['recursive'], tag=root['path']))
+            if watcher.pending == 0:
+                registration_done()
+
+            drained_time = time.time()
+            next_progress = time.monotonic() + PROGRESS_INTERVAL
+            next_stop_check = time.monotonic() + params.stop_check_interval
+            polling_event_number = 0
+            while True:
+                # wait for events no longer than the next pending deadline
+                deadlines = [next_stop_check, batcher.next_deadline(),
+                             None if debouncer is None else debouncer.next_deadline(),
+                             None if metrics is None else metrics.next_report]
+                timeout = max(0.0, min(deadline for deadline in deadlines
+                                       if deadline is not None) - time.monotonic())
+                if watcher.pending > 0:
+                    timeout = 0.0
+                elif limiter is not None and len(batcher) > 0:
+                    timeout = min(timeout, ADMISSION_POLL_INTERVAL)
+
+                # process all events that are pending in the inotify queue at once
+                events = watcher.read_events(timeout)
+                accepted = 0
+                for event_mask, _, watch_path, filename, root in events:
+                    # the watcher queued a rescan for the events that were lost
+                    if event_mask & constants.IN_Q_OVERFLOW:
+                        since = drained_time - RECONCILE_SLACK
+                        if reconcile['since'] is None or since < reconcile['since']:
+                            reconcile['since'] = since
+                        reconcile['known'].update(recent)
+                        logger.warning(
+                            'The inotify event queue overflowed ({} times so far, '
+                            'max_queued_events is {}), rescanning the watched '
+                            'directories'.format(watcher.overflows, max_queued_events()))
+                        continue
+
+                    if watch_path is None or event_mask & constants.IN_ISDIR:
+                        continue
+                    if matcher is not None and not matcher.matches(filename):
+                        continue
 
-                # in case of an event check whether it matches the mask and call a dag
-                if event is not None:
-                    (header, type_names, watch_path, filename) = event
+                    new_file = os.fsdecode(watch_path + b'/' + filename)
 
-                    if (not header.mask & constants.IN_ISDIR) and\
-                            (header.mask & mask):
-                        new_file = os.path.join(watch_path.decode('utf-8'),
-                                                filename.decode('utf-8'))
+                    # any event restarts the settle time of a pending file
+                    if debouncer is not None and new_file in debouncer:
+                        debouncer.touch(new_file)
+                    elif (event_mask & masks[root]) and \
+                            (regex is None or regex.search(new_file) is None):
+                        accepted += 1
+                        if debouncer is not None:
+                            debouncer.touch(new_file, root)
+                        else:
+                            add_file(new_file, root)
 
-                        add_file = not params.skip_duplicate or \
-                            (params.skip_duplicate and new_file not in files)
+                drained_time = time.time()
+                polling_event_number += len(events)
+                if metrics is not None:
+                    metrics.add_events(len(events), accepted)
 
-                        if add_file and regex is not None:
-                            add_file = regex.search(new_file) is None
+                # register the watches of the subdirectories in chunks
+                if watcher.pending > 0:
+                    add_registered(watcher.register_pending(REGISTER_CHUNK_SIZE))
+                    if watcher.pending == 0:
+                        registration_done()
+                    elif time.monotonic() >= next_progress:
+                        next_progress = time.monotonic() + PROGRESS_INTERVAL
+                        logger.info('Registered {} watches and {} polled directories, '
+                                    '{} directories pending'.format(
+                                        len(watcher), watcher.polled, watcher.pending))
 
-                        if add_file:
-                            files.append(new_file)
+                now = time.monotonic()
+                if debouncer is not None:
+                    for new_file, root in debouncer.pop_expired(now):
+                        add_file(new_file, root)
 
-                # as soon as enough files have been aggregated call the sub dag
-                if len(files) >= params.aggregate:
-                    chunks = len(files) // params.aggregate
-                    for i in range(0, chunks):
-                        if self._callback is not None:
-                            self._callback(files[0:params.aggregate], data,
-                                           store, signal, context)
-                        del files[0:params.aggregate]
+                # call the sub dag for each batch that is full or has waited too long
+                if limiter is None:
+                    for batch in batcher.pop_ready(now):
+                        flush(batch)
+                else:
+                    # only send as many lists as there are free dag slots
+                    available = limiter.available(len(dispatcher))
+                    for key in list(completed)[:available]:
+                        del completed[key]
+                        batch = batcher.pop(key)
+                        if batch is not None:
+                            flush(batch)
+                            available -= 1
+                    for batch in batcher.pop_ready(now, max_batches=available,
+                                                   max_files=max_files):
+                        flush(batch)
+
+                if metrics is not None and now >= metrics.next_report:
+                    metrics.report(
+                        now, pending_files=len(batcher) + (
+                            0 if debouncer is None else len(debouncer)),
+                        pending_batches=len(dispatcher), watches=len(watcher),
+                        polled=watcher.polled, overflows=watcher.overflows)
+
+                # check the stop signal in regular time intervals and, if requested,
+                # every stop_polling_rate events
+                dispatcher.check()
+                if now >= next_stop_check or (
+                        params.stop_polling_rate is not None and
+                        polling_event_number > params.stop_polling_rate):
+                    if signal.is_stopped:
+                        break
+                    next_stop_check = time.monotonic() + params.stop_check_interval
+                    polling_event_number = 0
+
+            # hand the batches that are still waiting to the callback
+            dispatcher.close()
 
         finally:
-            if not params.recursive:
-                notify.remove_watch(params.path.encode('utf-8'))
+            dispatcher.close(drain=False)
+            watcher.close()
+            if limiter is not None:
+                limiter.close()
+            if journal is not None:
+                journal.close()
 
         return Action(data)
+
+    @staticmethod
+    def _roots(params):
+        """ Return the options of each root directory as a list of dictionaries.
+
+        Args:
+            params (TaskParameters): The evaluated task parameters.
+
+        Raises:
+            LightflowFilesystemPathError: If a path is not absolute.
+            LightflowFilesystemConfigError: If a path has an unknown option.
+        """
+        paths = [params.path] if isinstance(params.path, (str, dict)) else params.path
+
+        roots = []
+        for path in paths:
+            root = {option: params[option] for option in ROOT_OPTIONS}
+            if isinstance(path, dict):
+                unknown = path.keys() - set(ROOT_OPTIONS) - {'path'}
+                if unknown:
+                    raise LightflowFilesystemConfigError(
+                        'Unknown path options: {}'.format(', '.join(sorted(unknown))))
+                root.update(path)
+            else:
+                root['path'] = path
+
+            if not os.path.isabs(root['path']):
+                raise LightflowFilesystemPathError(
+                    'The specified path is not an absolute path')
+            roots.append(root)
+        return roots
+
+    @staticmethod
+    def _group_function(group_by):
+        """ Return a callable that returns the group key of a file path.
+
+        Args:
+            group_by (str, None): Either 'parent' or a regular expression.
+
+        Returns:
+            callable: The callable or None if files are not grouped.
+        """
+        if group_by is None:
+            return None
+        if group_by == 'parent':
+            return os.path.dirname
+
+        pattern = re.compile(group_by)
+
+        def group_of(path):
+            match = pattern.search(path)
+            if match is None:
+                return None
+            return match.group(1) if pattern.groups > 0 else match.group(0)
+        return group_of
+
+    @staticmethod
+    def _file_stats(paths):
+        """ Return the (path, size, mtime) of the files that exist, mtime in ns. """
+        stats = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stats.append((path, stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    @staticmethod
+    def _file_size(path):
+        """ Return the size of a file in bytes or zero if the file does not exist. """
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
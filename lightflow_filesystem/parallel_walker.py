@@ -0,0 +1,207 @@
+import queue
+import threading
+from os import scandir
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# the time in seconds a worker waits for room in the result queue before checking
+# whether the walk was stopped
+PUT_TIMEOUT = 0.1
+
+# marks the end of the walk in the result queue
+_DONE = object()
+
+
+class ParallelWalker:
+    """ Walks down a directory tree by scanning several directories at once.
+
+    On filesystems with a high latency, such as NFS or GPFS, each scan of a directory
+    is a round trip to the server, during which a single thread would only wait. The
+    walker therefore lets a pool of threads scan the directories and yields the
+    DirEntry objects of the files as they come in.
+
+    In the default mode the threads take the directories from a shared work queue
+    and the files of a directory are yielded as soon as it has been scanned, such
+    that the order of the files is not deterministic. In the ordered mode the files
+    are yielded in the same order as a sequential depth-first walk. The directories
+    that come next in the walk are scanned ahead in parallel, up to a maximum
+    number of directories.
+
+    The directories that are descended into and the files that are yielded can be
+    selected by predicates, which are called before a directory is scanned or a
+    file is yielded.
+
+    Exceptions raised while scanning a directory, for example for missing
+    permissions, are raised by walk(). Closing the generator returned by walk()
+    stops the threads.
+    """
+    def __init__(self, workers=8, ordered=False, max_pending=None):
+        """ Initialize the parallel walker.
+
+        Args:
+            workers (int): The number of threads that scan directories.
+            ordered (bool): Yield the files in the order of a sequential walk.
+            max_pending (int, None): The maximum number of scanned directories whose
+                                     files have not been yielded yet. In the ordered
+                                     mode the maximum number of directories that
+                                     are scanned ahead of the walk. Defaults to
+                                     four times the number of threads.
+        """
+        self._workers = max(workers, 1)
+        self._ordered = ordered
+        self._max_pending = max_pending if max_pending is not None \
+            else 4 * self._workers
+
+    def walk(self, path, recursive=True, descend=None, accept=None):
+        """ Yield a DirEntry object for each file in a directory.
+
+        Args:
+            path (str): The path to the directory.
+            recursive (bool): Also yield the files of the subdirectories.
+            descend (callable, None): Called with the DirEntry of a subdirectory and
+                                      its depth, which is 1 for the subdirectories of
+                                      path, and returns whether the subdirectory is
+                                      walked. Set to None to walk all subdirectories.
+            accept (callable, None): Called with the DirEntry of a file and returns
+                                     whether the file is yielded. Set to None to
+                                     yield all files.
+
+        Returns:
+            generator: The DirEntry objects of the files.
+        """
+        if self._ordered:
+            return self._walk_ordered(path, recursive, descend, accept)
+        return self._walk_unordered(path, recursive, descend, accept)
+
+    def _walk_ordered(self, path, recursive, descend, accept):
+        """ Yield the files in the order of a sequential depth-first walk. """
+        pool = ThreadPoolExecutor(max_workers=self._workers)
+        stack = []
+        scanning = 0
+
+        def expand(future, depth):
+            # the entries of a scanned directory and its subdirectories to walk
+            entries = future.result()
+            subdirectories = deque()
+            if recursive:
+                subdirectories.extend(entry.path for entry in entries
+                                      if entry.is_dir(follow_symlinks=False) and
+                                      (descend is None or descend(entry, depth + 1)))
+            return iter(entries), subdirectories, {}
+
+        def scan_ahead():
+            # start scanning the subdirectories that come next in the walk, which
+            # are the ones of the deepest directory first
+            nonlocal scanning
+            for _, subdirectories, futures in reversed(stack):
+                while subdirectories and scanning < self._max_pending:
+                    directory = subdirectories.popleft()
+                    futures[directory] = pool.submit(self._scan, directory)
+                    scanning += 1
+
+        try:
+            stack.append(expand(pool.submit(self._scan, path), 0))
+            scan_ahead()
+            while stack:
+                entries, subdirectories, futures = stack[-1]
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        future = futures.pop(entry.path, None)
+                        if future is not None:
+                            scanning -= 1
+                        elif subdirectories and subdirectories[0] == entry.path:
+                            # the subdirectory was not scanned ahead
+                            future = pool.submit(self._scan, subdirectories.popleft())
+                        else:
+                            continue
+                        stack.append(expand(future, len(stack)))
+                        scan_ahead()
+                        break
+                    elif accept is None or accept(entry):
+                        yield entry
+                else:
+                    stack.pop()
+        finally:
+            for _, _, futures in stack:
+                for future in futures.values():
+                    future.cancel()
+            pool.shutdown(wait=True)
+
+    def _walk_unordered(self, path, recursive, descend, accept):
+        """ Yield the files of each directory as soon as it has been scanned. """
+        directories = queue.Queue()
+        results = queue.Queue(maxsize=self._max_pending)
+        stop = threading.Event()
+        lock = threading.Lock()
+        pending = 1
+
+        def work():
+            nonlocal pending
+            while True:
+                item = directories.get()
+                if item is None:
+                    return
+
+                directory, depth = item
+                files = []
+                try:
+                    for entry in scandir(directory):
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive and \
+                                    (descend is None or descend(entry, depth + 1)):
+                                with lock:
+                                    pending += 1
+                                directories.put((entry.path, depth + 1))
+                        elif accept is None or accept(entry):
+                            files.append(entry)
+                    result = files
+                except Exception as e:
+                    result = e
+
+                # the files are queued before the directory is counted as done, such
+                # that the end of the walk is always queued last
+                if not self._put(results, result, stop):
+                    return
+                with lock:
+                    pending -= 1
+                    done = pending == 0
+                if done and not self._put(results, _DONE, stop):
+                    return
+
+        threads = [threading.Thread(target=work, daemon=True)
+                   for _ in range(self._workers)]
+        directories.put((path, 0))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    return
+                if isinstance(result, Exception):
+                    raise result
+                yield from result
+        finally:
+            stop.set()
+            for _ in threads:
+                directories.put(None)
+            for thread in threads:
+                thread.join()
+
+    @staticmethod
+    def _scan(path):
+        """ Return the DirEntry objects of a directory as a list. """
+        return list(scandir(path))
+
+    @staticmethod
+    def _put(results, result, stop):
+        """ Queue a result unless the walk is stopped and return whether it is queued. """
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
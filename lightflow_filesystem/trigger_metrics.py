@@ -0,0 +1,130 @@
+import time
+import threading
+from collections import deque
+
+from lightflow.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+# the percentiles of the callback duration that are reported
+PERCENTILES = (50, 90, 99)
+
+
+class TriggerMetrics:
+    """ Collects throughput and latency figures of a trigger task.
+
+    The task adds the number of events it read and accepted after each read, and
+    the dispatcher adds the latency and duration of each callback. In regular
+    intervals the figures are written as a single key=value log line and, if a key
+    is given, to the workflow data store. Only the callback durations of the most
+    recent callbacks are kept for computing the percentiles.
+    """
+    def __init__(self, name, interval, store=None, store_key=None, window=1024):
+        """ Initialize the trigger metrics.
+
+        Args:
+            name (str): The name of the task, which is added to the log line.
+            interval (float): The time in seconds between two reports.
+            store (DataStoreDocument, None): The data store the figures are
+                                             written to.
+            store_key (str, None): The key under which the figures are stored.
+                                   Set to None to only log the figures.
+            window (int): The number of callback durations that are kept.
+        """
+        self._name = name
+        self._interval = interval
+        self._store = store
+        self._store_key = store_key
+
+        self._lock = threading.Lock()
+        self._durations = deque(maxlen=window)
+        self._latencies = []
+
+        self._events = 0
+        self._accepted = 0
+        self._callbacks = 0
+        self._total_events = 0
+        self._total_accepted = 0
+        self._total_callbacks = 0
+
+        self._last_report = time.monotonic()
+        self.next_report = self._last_report + interval
+
+    def add_events(self, events, accepted):
+        """ Count the events of a single read.
+
+        Args:
+            events (int): The number of events that were read.
+            accepted (int): The number of events that passed all filters.
+        """
+        self._events += events
+        self._accepted += accepted
+
+    def add_callback(self, latency, duration):
+        """ Record a call of the callback. Can be called from any thread.
+
+        Args:
+            latency (float): The time in seconds between the oldest item of the
+                             batch being ready and the start of the callback.
+            duration (float): The time in seconds the callback took.
+        """
+        with self._lock:
+            self._callbacks += 1
+            self._latencies.append(latency)
+            self._durations.append(duration)
+
+    def report(self, now=None, **gauges):
+        """ Log and store the figures if the report is due.
+
+        Args:
+            now (float, None): The current monotonic time. Defaults to the current time.
+            **gauges: Additional figures describing the current state, for example
+                      the number of pending files, that are added to the report.
+
+        Returns:
+            dict: The reported figures or None if the report was not due.
+        """
+        now = time.monotonic() if now is None else now
+        if now < self.next_report:
+            return None
+
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, 0
+            latencies, self._latencies = self._latencies, []
+            durations = sorted(self._durations)
+
+        elapsed = max(now - self._last_report, 1e-9)
+        self._total_events += self._events
+        self._total_accepted += self._accepted
+        self._total_callbacks += callbacks
+
+        figures = {
+            'events_per_sec': round(self._events / elapsed, 2),
+            'events': self._events,
+            'accepted': self._accepted,
+            'filtered': self._events - self._accepted,
+            'callbacks': callbacks,
+            'total_events': self._total_events,
+            'total_accepted': self._total_accepted,
+            'total_callbacks': self._total_callbacks,
+            'latency_mean': round(sum(latencies) / len(latencies), 4)
+            if latencies else None,
+            'latency_max': round(max(latencies), 4) if latencies else None,
+        }
+        for percentile in PERCENTILES:
+            figures['callback_p{}'.format(percentile)] = \
+                round(durations[min(len(durations) * percentile // 100,
+                                    len(durations) - 1)], 4) if durations else None
+        figures.update(gauges)
+
+        self._events = 0
+        self._accepted = 0
+        self._last_report = now
+        self.next_report = now + self._interval
+
+        logger.info('{} metrics {}'.format(self._name, ' '.join(
+            '{}={}'.format(key, value) for key, value in figures.items())))
+        if self._store is not None and self._store_key is not None:
+            self._store.set(self._store_key, figures)
+        return figures
@@ -1,23 +1,53 @@
-from os import scandir
+from os import scandir, fsencode
 from os.path import isabs
+from itertools import islice
+from collections import namedtuple
 
 from lightflow.queue import JobType
 from lightflow.logger import get_logger
 from lightflow.models import BaseTask, TaskParameters, Action
 from .exceptions import LightflowFilesystemPathError
+from .file_columns import StatCollector
+from .file_matcher import FileMatcher
+from .parallel_walker import ParallelWalker
 
 logger = get_logger(__name__)
 
+# the number of files after which a parallel walk without batches checks whether
+# the task was stopped
+STOP_CHECK_FILES = 1000
+
+# the stat figures of a file that are handed to the callback instead of its DirEntry
+FileRecord = namedtuple('FileRecord', ['path', 'size', 'mtime', 'mode', 'inode'])
+
 
 class WalkTask(BaseTask):
-    """ Walks (recursively) down a directory and calls a callable for each file. """
-    def __init__(self, name, path, callback, recursive=False, *, queue=JobType.Task,
+    """ Walks (recursively) down a directory and calls a callable for each file.
+
+    The callable can also be called with batches of files, in which case the task
+    checks between two batches whether it should be stopped. On filesystems with a
+    high latency the directories can be scanned by several threads at once.
+
+    Subdirectories can be skipped by their depth, their name or a predicate before
+    they are scanned, and files can be skipped by their name before any of their
+    figures are read.
+
+    Instead of one object per file, the stat figures of the files can be collected
+    into NumPy structured arrays, such that statistics over the files can be
+    computed with vectorized operations. This requires the optional NumPy package.
+    """
+    def __init__(self, name, path, callback, recursive=False, batch_size=None,
+                 records=False, workers=None, ordered=False, max_depth=None,
+                 include=None, exclude=None, exclude_dirs=None, prune=None,
+                 columnar=False, *,
+                 queue=JobType.Task,
                  callback_init=None, callback_finally=None,
                  force_run=False, propagate_skip=True):
         """ Initialize the walk task object.
 
-        All task parameters except the name, callback, queue, force_run and propagate_skip
-        can either be their native type or a callable returning the native type.
+        All task parameters except the name, callback, prune, queue, force_run and
+        propagate_skip can either be their native type or a callable returning the
+        native type.
 
         Args:
             name (str): The name of the task.
@@ -29,6 +59,57 @@ class WalkTask(BaseTask):
                                  def callback(entry, data, store, signal, context).
                                  where entry is of type os.DirEntry.
             recursive (bool): Recursively look for files in the directory.
+            batch_size (int, None): The number of files that are handed to the
+                                    callback at once as a list, which replaces the
+                                    entry argument of the callback. The stop signal
+                                    is checked after each batch. Set to None to
+                                    call the callback for each file.
+            records (bool): Hand a FileRecord with the path, size, modification
+                            time, mode and inode of each file to the callback
+                            instead of its os.DirEntry. The figures are taken
+                            from the file itself, not from the target of a
+                            symbolic link. Files that are deleted before their
+                            figures are taken are skipped.
+            workers (int, None): The number of threads that scan directories in
+                                 parallel, which speeds up the walk on network
+                                 filesystems. Without a batch size the stop
+                                 signal is checked every 1000 files. Set to None
+                                 to walk the directories one after the other.
+            ordered (bool): If directories are scanned in parallel, hand the files to
+                            the callback in the same order as a sequential walk.
+                            Otherwise the files of a directory are handed over as
+                            soon as it has been scanned.
+            max_depth (int, None): The maximum depth of the subdirectories that are
+                                   walked if recursive is True, where the
+                                   subdirectories of path have a depth of 1. Set to
+                                   None to walk all subdirectories.
+            include (str, list, None): A pattern or a list of patterns of which the name
+                                       of a file has to match at least one. Patterns
+                                       are globs, such as '*.h5', or regular
+                                       expressions prefixed by 're:'. Set to None to
+                                       include all files.
+            exclude (str, list, None): A pattern or a list of patterns of which the name
+                                       of a file must not match any. Set to None to
+                                       exclude no files.
+            exclude_dirs (str, list, None): A pattern or a list of patterns for the
+                                            names of subdirectories that are not
+                                            walked, such as '.snapshot'. Set to None
+                                            to walk all subdirectories.
+            prune (callable, None): A callable that is called with the os.DirEntry of
+                                    each subdirectory before it is walked and returns
+                                    True if the subdirectory and its whole subtree
+                                    should be skipped. The definition is
+                                    def prune(entry). If 'workers' is set, it is
+                                    called from several threads at once. Set to
+                                    None to walk all subdirectories.
+            columnar (bool): Hand a FileColumns tuple to the callback, which holds the
+                             list of paths and a NumPy structured array with the
+                             columns path, size, mtime, uid and mode of the files.
+                             The path column is the index of the file among all
+                             files of the walk. The callback is called once per
+                             batch or, if batch_size is None, once with all files.
+                             If workers is set, the files are also stat'ed by that
+                             number of threads. Requires NumPy.
             queue (str): Name of the queue the task should be scheduled to. Defaults to
                          the general task queue.
             callback_init (callable): A callable that is called shortly before the task
@@ -58,9 +139,19 @@ class WalkTask(BaseTask):
                          force_run=force_run, propagate_skip=propagate_skip)
 
         self.params = TaskParameters(path=path,
-                                     recursive=recursive
+                                     recursive=recursive,
+                                     batch_size=batch_size,
+                                     records=records,
+                                     workers=workers,
+                                     ordered=ordered,
+                                     max_depth=max_depth,
+                                     include=include,
+                                     exclude=exclude,
+                                     exclude_dirs=exclude_dirs,
+                                     columnar=columnar
                                      )
         self._callback = callback
+        self._prune = prune
 
     def run(self, data, store, signal, context, **kwargs):
         """ The main run method of the walk task.
@@ -77,6 +168,8 @@ class WalkTask(BaseTask):
 
         Raises:
             LightflowFilesystemPathError: If the specified path is not absolute.
+            LightflowFilesystemConfigError: If the columnar mode is requested but
+                                            NumPy is not installed.
 
         Returns:
             Action: An Action object containing the data that should be passed on
@@ -89,17 +182,101 @@ class WalkTask(BaseTask):
             raise LightflowFilesystemPathError(
                 'The specified path is not an absolute path')
 
-        for entry in self._scantree(params.path, params.recursive):
-            if self._callback is not None:
-                self._callback(entry, data, store, signal, context)
+        descend = self._descend_function(params.max_depth, params.exclude_dirs,
+                                         self._prune)
+        if params.include is not None or params.exclude is not None:
+            matcher = FileMatcher(include=params.include, exclude=params.exclude)
+
+            def accept(entry):
+                return matcher(fsencode(entry.name))
+        else:
+            accept = None
+
+        if params.workers is not None:
+            walker = ParallelWalker(workers=params.workers, ordered=params.ordered)
+            walk = walker.walk(params.path, params.recursive, descend, accept)
+        else:
+            walk = self._scantree(params.path, params.recursive, descend, accept)
+        entries = filter(None, map(self._record, walk)) \
+            if params.records and not params.columnar else walk
+        collector = StatCollector(workers=params.workers) if params.columnar else None
+
+        try:
+            if params.batch_size is None and collector is None:
+                for count, entry in enumerate(entries, 1):
+                    if self._callback is not None:
+                        self._callback(entry, data, store, signal, context)
+                    if params.workers is not None and \
+                            count % STOP_CHECK_FILES == 0 and signal.is_stopped:
+                        break
+                return Action(data)
+
+            while True:
+                if params.batch_size is not None:
+                    batch = list(islice(entries, max(params.batch_size, 1)))
+                else:
+                    batch = list(entries)
+                if not batch:
+                    break
+
+                if collector is not None:
+                    batch = collector.collect(batch)
+                if self._callback is not None:
+                    self._callback(batch, data, store, signal, context)
+
+                if params.batch_size is None or signal.is_stopped:
+                    break
+        finally:
+            # stops the threads of a parallel walk that ended early
+            walk.close()
+            if collector is not None:
+                collector.close()
 
         return Action(data)
 
-    def _scantree(self, path, recursive=True):
+    @staticmethod
+    def _record(entry):
+        """ Return the FileRecord of a DirEntry or None if the file no longer exists. """
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            return None
+        return FileRecord(entry.path, stat.st_size, stat.st_mtime, stat.st_mode,
+                          entry.inode())
+
+    @staticmethod
+    def _descend_function(max_depth, exclude_dirs, prune):
+        """ Return a callable that decides whether a subdirectory is walked.
+
+        Args:
+            max_depth (int, None): The maximum depth of the walked subdirectories.
+            exclude_dirs (str, list, None): The patterns of excluded directory names.
+            prune (callable, None): The predicate for skipping a subdirectory.
+
+        Returns:
+            callable: The callable, which is called with the DirEntry and the depth
+                      of a subdirectory, or None if all subdirectories are walked.
+        """
+        if max_depth is None and exclude_dirs is None and prune is None:
+            return None
+
+        excluded = FileMatcher(include=exclude_dirs) \
+            if exclude_dirs is not None else None
+
+        def descend(entry, depth):
+            if max_depth is not None and depth > max_depth:
+                return False
+            if excluded is not None and excluded(fsencode(entry.name)):
+                return False
+            return prune is None or not prune(entry)
+        return descend
+
+    def _scantree(self, path, recursive=True, descend=None, accept=None, depth=0):
         """ (recursively) yield DirEntry objects for directory given by the path."""
         for entry in scandir(path):
             if entry.is_dir(follow_symlinks=False):
-                if recursive:
-                    yield from self._scantree(entry.path)
-            else:
+                if recursive and (descend is None or descend(entry, depth + 1)):
+                    yield from self._scantree(entry.path, True, descend, accept,
+                                              depth + 1)
+            elif accept is None or accept(entry):
                 yield entry
@@ -43,4 +43,8 @@ setup(
         'inotify>=0.2.8'
     ],
 
+    extras_require={
+        'numpy': ['numpy']
+    },
+
 )